@@ -45,18 +45,12 @@ class User(AbstractUser):
 
     @property
     def desk_available(self):
-        from combinations.models import DeskType
-        Desk = apps.get_model('combinations', 'Desk')
-        return Desk.objects.get(user=self, type=DeskType.AVAILABLE)
+        return apps.get_model('combinations', 'Desk').desk_available(self)
 
     @property
     def desk_postcard(self):
-        from combinations.models import DeskType
-        Desk = apps.get_model('combinations', 'Desk')
-        return Desk.objects.get(user=self, type=DeskType.POSTCARD)
+        return apps.get_model('combinations', 'Desk').desk_postcard(self)
 
     @property
     def desk_removed(self):
-        from combinations.models import DeskType
-        Desk = apps.get_model('combinations', 'Desk')
-        return Desk.objects.get(user=self, type=DeskType.REMOVED)
+        return apps.get_model('combinations', 'Desk').desk_removed(self)
@@ -0,0 +1,188 @@
+"""
+Caches for combination results.
+
+CompressedFileCache is shared by all gunicorn workers of a node. Django's
+FileBasedCache already keeps one zlib-compressed pickle per key in a directory
+every worker can see; on top of it this backend caps the total size in bytes,
+evicts the least recently used entries instead of random ones, and counts hits
+and misses. The counters belong to the process; each worker logs its own at
+every scan of the directory.
+
+LocalCache is a small in-process tier in front of it, so paging through a
+result does not unpickle it again for every page.
+"""
+import os
+import pickle
+import threading
+import zlib
+from collections import Counter, OrderedDict
+from logging import getLogger
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+
+EVICT_EVERY = 100  # writes between full scans of the cache directory
+
+logger = getLogger()
+
+_missing = object()
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _counters() -> dict:
+    with _stats_lock:
+        return {name: _stats[name] for name in ('hits', 'misses', 'evictions', 'local_hits', 'local_misses')}
+
+
+class CompressedFileCache(FileBasedCache):
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        options = params.get('OPTIONS', {})
+        self._max_bytes = options.get('MAX_BYTES', 256 * 1024 * 1024)
+        self._compress_level = options.get('COMPRESS_LEVEL', 6)
+        self._usage = None  # (entries, bytes) of the directory as last scanned, plus our writes since
+        self._writes = 0
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version)
+        if value is _missing:
+            _count('misses')
+            return default
+
+        _count('hits')
+        try:
+            os.utime(self._key_to_file(key, version))  # mtime is the last use
+        except FileNotFoundError:
+            pass
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version)
+        self._written(self._key_to_file(key, version))
+
+    def _write_content(self, file, timeout, value):
+        expiry = self.get_backend_timeout(timeout)
+        file.write(pickle.dumps(expiry, self.pickle_protocol))
+        file.write(zlib.compress(pickle.dumps(value, self.pickle_protocol), self._compress_level))
+
+    def _cull(self):
+        pass  # replaced by _evict(), which runs after the write and sees its size
+
+    def _written(self, fname: str):
+        """
+        Add a written file to the running usage, and scan the directory only
+        when the usage goes over a limit or every EVICT_EVERY writes, which
+        picks up the writes of the other workers.
+        """
+        self._writes += 1
+        if self._usage is not None and self._writes < EVICT_EVERY:
+            try:
+                size = os.stat(fname).st_size
+            except FileNotFoundError:
+                size = 0
+            entries, total = self._usage
+            self._usage = entries + 1, total + size
+            if entries + 1 <= self._max_entries and total + size <= self._max_bytes:
+                return
+        self._evict()
+
+    def _evict(self):
+        """Evict the least recently used entries once the entry or byte limit is exceeded."""
+        self._writes = 0
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        self._usage = len(entries), total
+        counters = ', '.join(f'{value} {name}' for name, value in _counters().items())
+        logger.info(f'Combination cache of process {os.getpid()}: {counters}, {len(entries)} entries, {total} bytes')
+        if len(entries) <= self._max_entries and total <= self._max_bytes:
+            return
+
+        # Like Django, free a 1/CULL_FREQUENCY share of the entries, and at
+        # least a tenth of the byte cap so the next set does not cull again.
+        keep_entries = self._max_entries - self._max_entries // self._cull_frequency if self._cull_frequency else 0
+        keep_bytes = self._max_bytes * 9 // 10
+        remaining = len(entries)
+        for fname, size, _ in sorted(entries, key=lambda x: x[2]):
+            if remaining <= keep_entries and total <= keep_bytes:
+                break
+            if self._delete(fname):
+                _count('evictions')
+            remaining -= 1
+            total -= size
+        self._usage = remaining, total
+
+    def _entries(self) -> list[tuple[str, int, float]]:
+        entries = []
+        for fname in self._list_cache_files():
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entries.append((fname, stat.st_size, stat.st_mtime))
+        return entries
+
+    def stats(self) -> dict:
+        """Hit, miss and eviction counters of this process, and the size of the shared cache."""
+        entries = self._entries()
+        return {
+            **_counters(),
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU. Keys are expected to carry their own version (the
+    combination cache key includes the inventory fingerprint and settings), so
+    an entry is valid for as long as the shared tier would compute the same key.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                _count('local_misses')
+                return default
+            self._entries.move_to_end(key)
+        _count('local_hits')
+        return value
+
+    def set(self, key, value, size: int):
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        if key in self._entries:
+            _, size = self._entries.pop(key)
+            self._bytes -= size
@@ -0,0 +1,673 @@
+"""
+Combination search over stamp denominations.
+
+The engine knows nothing about Django models: values are integer cents and
+stamps are grouped into denominations, one per StampSample, with a cap on how
+many copies of it may go into a single combination. A combination is
+a pattern - a non-decreasing tuple of denomination indices, so copies of the
+same sample are never told apart and duplicates are never produced.
+"""
+import bisect
+import functools
+import hashlib
+import heapq
+import math
+import multiprocessing
+import operator
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+from dataclasses import dataclass, replace
+from decimal import Decimal
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+
+Pattern = tuple[int, ...]
+
+NUMPY_CHUNK = 65_536
+PARALLEL_THRESHOLD = 20_000  # patterns; smaller problems are not worth sending to the pool
+
+
+def to_cents(value) -> int:
+    return int((Decimal(value) * 100).to_integral_value())
+
+
+@dataclass(frozen=True)
+class Denomination:
+    key: int  # StampSample id
+    value: int  # cents
+    cap: int  # max copies in one combination
+    required: int = 0  # copies already on the postcard
+    copies: int = 0  # copies owned, only used to rank combinations
+
+
+@dataclass(frozen=True)
+class Window:
+    low: int  # cents
+    high: int  # cents
+    k_min: int
+    k_max: int
+
+
+Search = Callable[[list[Denomination], Window], Iterator[Pattern]]
+Objective = Callable[[Pattern, list[Denomination]], tuple]  # smaller is better
+
+
+def digest(denominations: list[Denomination], *extra) -> str:
+    """
+    Digest of a problem without the sample ids.
+
+    Patterns index denominations in canonical order, so they are valid for
+    every inventory with the same values, caps and required copies, whoever
+    owns the stamps.
+    """
+    canonical = [(x.value, x.cap, x.required) for x in denominations]
+    return hashlib.sha1(repr((canonical, *extra)).encode()).hexdigest()
+
+
+def _reach(denominations: list[Denomination], k_max: int) -> list[list[int]]:
+    """reach[i][r] is the largest sum of at most r stamps taken from denominations[i:]."""
+    reach = [[0] * (k_max + 1) for _ in range(len(denominations) + 1)]
+    for index in range(len(denominations) - 1, -1, -1):
+        denomination = denominations[index]
+        for room in range(k_max + 1):
+            reach[index][room] = max(
+                count * denomination.value + reach[index + 1][room - count]
+                for count in range(min(denomination.cap, room) + 1)
+            )
+    return reach
+
+
+def multisets(denominations: list[Denomination], window: Window) -> Iterator[Pattern]:
+    """
+    Yield every pattern of k_min..k_max stamps with a sum inside the window.
+
+    Depth-first search over value-sorted denominations: a branch is cut as soon
+    as its partial sum (with the stamps it still has to take) goes over the
+    upper bound, or the largest values left can't lift it to the lower bound.
+    """
+    reach = _reach(denominations, window.k_max)
+    pending = [0] * (len(denominations) + 1)  # value and count of required stamps in denominations[i:]
+    pending_count = [0] * (len(denominations) + 1)
+    for index in range(len(denominations) - 1, -1, -1):
+        denomination = denominations[index]
+        pending[index] = pending[index + 1] + denomination.required * denomination.value
+        pending_count[index] = pending_count[index + 1] + denomination.required
+
+    stack = []
+
+    def walk(index: int, total: int) -> Iterator[Pattern]:
+        depth = len(stack)
+        room = window.k_max - depth
+        if not pending_count[index] and depth >= window.k_min and total >= window.low:
+            yield tuple(stack)
+
+        for next_index in range(index, len(denominations)):
+            denomination = denominations[next_index]
+            if total + denomination.value > window.high or total + reach[next_index][room] < window.low:
+                break
+
+            for count in range(1, min(denomination.cap, room) + 1):
+                subtotal = total + count * denomination.value
+                if subtotal + pending[next_index + 1] > window.high:
+                    break
+                stack.append(next_index)
+                if count >= denomination.required and pending_count[next_index + 1] <= room - count:
+                    yield from walk(next_index + 1, subtotal)
+            del stack[depth:]
+
+            if denomination.required:
+                break
+
+    if pending[0] <= window.high and pending_count[0] <= window.k_max:
+        yield from walk(0, 0)
+
+
+def sum_counts(denominations: list[Denomination], window: Window) -> tuple[int, list[array]]:
+    """
+    Count patterns by stamp number and sum without enumerating them.
+
+    Returns (step, table) where table[k][s] is the number of patterns of
+    k stamps summing to exactly s * step cents, for sums up to the window's
+    upper bound. Step is the gcd of all values, which keeps the table short
+    when all stamps are in whole rubles.
+
+    Every row is computed as one integer with a fixed-width slot per sum, so
+    adding a denomination is a handful of shifts and additions instead of
+    a loop over every sum. Slots are 32 bits wide unless there may be more
+    patterns than that, then 64.
+    """
+    step = math.gcd(*(x.value for x in denominations)) or 1
+    size = window.high // step + 1
+    typecode = 'I' if math.comb(len(denominations) + window.k_max, window.k_max) < 2 ** 32 else 'Q'
+    bits = array(typecode).itemsize * 8
+    mask = (1 << size * bits) - 1
+    rows = [1] + [0] * window.k_max
+
+    for denomination in denominations:
+        value = denomination.value // step
+        updated = [0] * (window.k_max + 1)
+        for count in range(denomination.required, min(denomination.cap, window.k_max) + 1):
+            shift = count * value
+            if shift >= size:
+                break
+            for k in range(window.k_max - count + 1):
+                if rows[k]:
+                    updated[k + count] += rows[k] << shift * bits
+        rows = [row & mask for row in updated]
+
+    return step, [array(typecode, row.to_bytes(size * bits // 8, sys.byteorder)) for row in rows]
+
+
+def count(denominations: list[Denomination], window: Window) -> int:
+    """Exact number of patterns multisets() would yield."""
+    if window.high < 0:
+        return 0
+    step, table = sum_counts(denominations, window)
+    low = -(-window.low // step)
+    return sum(sum(table[k][low:]) for k in range(window.k_min, window.k_max + 1))
+
+
+@dataclass(frozen=True)
+class SumTable:
+    """
+    What ordered() needs to know about a problem before it yields anything.
+
+    counts[k][s] is the number of patterns of k stamps summing to s * step
+    cents, and reach[i][k] has bit s set when k stamps of denominations[:i]
+    can sum to s * step; the bitsets are kept as bytes, where testing a bit
+    does not copy the whole set. Both only depend on the denominations and
+    the window, so a caller serving several pages builds the table once.
+    """
+    step: int
+    counts: list[array]
+    reach: list[list[bytes]]
+
+    @classmethod
+    def build(cls, denominations: list[Denomination], window: Window) -> 'SumTable':
+        step, counts = sum_counts(denominations, window)
+        mask = (1 << window.high // step + 1) - 1
+
+        reach = [[1] + [0] * window.k_max]
+        for denomination in denominations:
+            value = denomination.value // step
+            previous = reach[-1]
+            current = [0] * (window.k_max + 1)
+            for k in range(window.k_max + 1):
+                for count in range(denomination.required, min(denomination.cap, k) + 1):
+                    current[k] |= previous[k - count] << (count * value)
+                current[k] &= mask
+            reach.append(current)
+
+        width = (window.high // step) // 8 + 1
+        return cls(
+            step=step,
+            counts=counts,
+            reach=[[bits.to_bytes(width, 'little') for bits in row] for row in reach],
+        )
+
+    @staticmethod
+    def cells(denominations: list[Denomination], window: Window) -> int:
+        """Number of (stamp number, sum) cells build() shifts in, a measure of its time."""
+        step = math.gcd(*(x.value for x in denominations)) or 1
+        shifts = sum(max(min(x.cap, window.k_max) - x.required + 1, 0) for x in denominations)
+        return shifts * (window.k_max + 1) * (max(window.high, 0) // step + 1)
+
+    def nbytes(self) -> int:
+        return sum(row.itemsize * len(row) for row in self.counts) + \
+            sum(len(bits) for row in self.reach for bits in row)
+
+
+def ordered(
+        denominations: list[Denomination],
+        window: Window,
+        offset: int = 0,
+        table: SumTable | None = None,
+) -> Iterator[Pattern]:
+    """
+    Yield patterns in ascending sum order, starting from the offset-th one.
+
+    Every (stamp number, sum) bucket is a separate stream; the streams are
+    merged on a heap by sum. Buckets before the offset are skipped using their
+    sizes from the counts of the table. A bucket is enumerated by walking back
+    through the table's per-prefix bitsets of reachable sums, so every step
+    leads to a pattern, and branches before the offset are skipped by their
+    memoized sizes. The table is built here unless it is passed in.
+    """
+    if window.high < 0:
+        return
+    table = table or SumTable.build(denominations, window)
+    step, counts, reach = table.step, table.counts, table.reach
+    size = window.high // step + 1
+
+    def choices(index: int, k: int, total: int) -> Iterator[tuple[int, int, int]]:
+        """Counts of denominations[index - 1] that leave a reachable rest."""
+        denomination = denominations[index - 1]
+        value = denomination.value // step
+        for count in range(denomination.required, min(denomination.cap, k) + 1):
+            rest = total - count * value
+            if rest < 0:
+                break
+            if reach[index - 1][k - count][rest >> 3] >> (rest & 7) & 1:
+                yield count, k - count, rest
+
+    # A reachable state without stamps left has exactly one way: none of the rest
+    @functools.cache
+    def ways(index: int, k: int, total: int) -> int:
+        if not index or not k:
+            return 1
+        return sum(ways(index - 1, rest_k, rest) for _, rest_k, rest in choices(index, k, total))
+
+    stack = []
+
+    def walk(index: int, k: int, total: int, skip: int) -> Iterator[Pattern]:
+        if not index or not k:
+            yield tuple(reversed(stack))
+            return
+
+        for count, rest_k, rest in choices(index, k, total):
+            if skip:
+                size = ways(index - 1, rest_k, rest)
+                if skip >= size:
+                    skip -= size
+                    continue
+
+            stack.extend([index - 1] * count)
+            yield from walk(index - 1, rest_k, rest, skip)
+            del stack[len(stack) - count:]
+            skip = 0
+
+    low = -(-window.low // step)
+
+    def sums(k: int) -> Iterator[tuple[int, int]]:
+        return ((total, k) for total in range(low, size) if counts[k][total])
+
+    buckets = heapq.merge(*(sums(k) for k in range(window.k_min, window.k_max + 1)))
+    for total, k in buckets:
+        if offset >= counts[k][total]:
+            offset -= counts[k][total]
+            continue
+
+        yield from walk(len(denominations), k, total, offset)
+        offset = 0
+
+
+def budgeted(
+        patterns: Iterable[Pattern],
+        seconds: float | None = None,
+        limit: int | None = None,
+) -> tuple[list[Pattern], bool]:
+    """
+    Take patterns from a best-first stream such as ordered() until the time
+    or work budget runs out, so what is returned is the best found so far.
+    The flag tells whether the stream was exhausted - the patterns are all
+    there are.
+    """
+    deadline = None if seconds is None else time.monotonic() + seconds
+    taken = []
+    for pattern in patterns:
+        if len(taken) == limit or deadline is not None and time.monotonic() >= deadline:
+            return taken, False
+        taken.append(pattern)
+    return taken, True
+
+
+def vectorized(denominations: list[Denomination], window: Window) -> Iterator[Pattern]:
+    """
+    Same patterns as multisets(), evaluated with NumPy on int64 cent arrays.
+
+    Patterns are grown one stamp at a time in blocks of at most NUMPY_CHUNK
+    rows: every row is extended by each denomination not below its last one,
+    and sums, repeat caps and the upper bound are checked for the whole block
+    at once. Only the rows that survive are turned back into tuples.
+    """
+    if not window.k_min and window.low <= 0 <= window.high:
+        yield ()
+    if not denominations or not window.k_max:
+        return
+
+    values = np.array([x.value for x in denominations], dtype=np.int64)
+    caps = np.array([x.cap for x in denominations], dtype=np.int64)
+    required = [(index, x.required) for index, x in enumerate(denominations) if x.required]
+    size = len(denominations)
+
+    first = np.flatnonzero((caps > 0) & (values <= window.high))
+    blocks = [(first[:, None], values[first], np.ones(len(first), dtype=np.int64))]
+    while blocks:
+        rows, totals, runs = blocks.pop()
+        if not len(rows):
+            continue
+
+        if rows.shape[1] >= window.k_min:
+            mask = totals >= window.low
+            for index, copies in required:
+                mask &= (rows == index).sum(axis=1) >= copies
+            yield from map(tuple, rows[mask].tolist())
+
+        if rows.shape[1] == window.k_max:
+            continue
+
+        last = rows[:, -1]
+        children = size - last
+        parents = np.repeat(np.arange(len(rows)), children)
+        following = last[parents] + np.arange(len(parents)) - np.repeat(np.cumsum(children) - children, children)
+        child_totals = totals[parents] + values[following]
+        child_runs = np.where(following == last[parents], runs[parents] + 1, 1)
+        keep = (child_runs <= caps[following]) & (child_totals <= window.high)
+
+        child_rows = np.hstack([rows[parents[keep]], following[keep, None]])
+        child_totals, child_runs = child_totals[keep], child_runs[keep]
+        for start in range(0, len(child_rows), NUMPY_CHUNK):
+            end = start + NUMPY_CHUNK
+            blocks.append((child_rows[start:end], child_totals[start:end], child_runs[start:end]))
+
+
+def _meet(denominations: list[Denomination], window: Window, k: int) -> Iterator[Pattern]:
+    head_size = k // 2
+    tail_size = k - head_size
+    free = [replace(x, required=0) for x in denominations]
+    cheapest = denominations[0].value
+
+    tails = [[] for _ in denominations]  # tails[i]: (sum, pattern) of tails starting with denomination i
+    for pattern in multisets(free, Window(0, window.high - head_size * cheapest, tail_size, tail_size)):
+        tails[pattern[0]].append((sum(denominations[i].value for i in pattern), pattern))
+    for bucket in tails:
+        bucket.sort()
+    tail_sums = [[total for total, _ in bucket] for bucket in tails]
+
+    required = [(index, x.required) for index, x in enumerate(denominations) if x.required]
+    for head in multisets(free, Window(0, window.high - tail_size * cheapest, head_size, head_size)):
+        total = sum(denominations[i].value for i in head)
+        last = head[-1]
+        run = head.count(last)
+        for first in range(last, len(denominations)):
+            if total + tail_size * denominations[first].value > window.high:
+                break
+
+            bucket = tails[first]
+            start = bisect.bisect_left(tail_sums[first], window.low - total)
+            end = bisect.bisect_right(tail_sums[first], window.high - total)
+            for _, tail in bucket[start:end]:
+                if first == last and run + tail.count(last) > denominations[last].cap:
+                    continue
+                pattern = head + tail
+                if required and any(pattern.count(index) < copies for index, copies in required):
+                    continue
+                yield pattern
+
+
+def meet_in_the_middle(denominations: list[Denomination], window: Window) -> Iterator[Pattern]:
+    """
+    Same patterns as multisets(); combinations of 4 and 5 stamps are joined
+    from two halves.
+
+    The smaller half (a pair) is enumerated directly, the larger one (a pair or
+    a triple) is bucketed by its first denomination and sorted by sum, so the
+    complements of a pair that land in the window are found by binary search.
+    Halves join only in index order, which keeps patterns canonical, and
+    the repeat cap is checked where they meet.
+    """
+    for k in range(window.k_min, window.k_max + 1):
+        if k < 4:
+            yield from multisets(denominations, replace(window, k_min=k, k_max=k))
+        elif denominations:
+            yield from _meet(denominations, window, k)
+
+
+@dataclass(frozen=True)
+class SumIndex:
+    """
+    Every pattern of exactly k stamps, sorted by sum.
+
+    It doesn't depend on the value window, so once built for an inventory
+    any window is answered by bisecting the sums. Patterns are stored
+    flattened, k indices per pattern.
+    """
+    k: int
+    sums: array
+    patterns: array
+
+    @classmethod
+    def size(cls, denominations: list[Denomination], k: int) -> int:
+        return count(*cls._problem(denominations, k))
+
+    @classmethod
+    def build(cls, denominations: list[Denomination], k: int) -> 'SumIndex':
+        free, window = cls._problem(denominations, k)
+        entries = sorted(
+            (sum(denominations[i].value for i in pattern), pattern)
+            for pattern in meet_in_the_middle(free, window)
+        )
+        return cls(
+            k=k,
+            sums=array('q', (total for total, _ in entries)),
+            patterns=array('I', (index for _, pattern in entries for index in pattern)),
+        )
+
+    @staticmethod
+    def _problem(denominations: list[Denomination], k: int) -> tuple[list[Denomination], Window]:
+        free = [replace(x, required=0) for x in denominations]
+        top = k * max((x.value for x in denominations), default=0)
+        return free, Window(0, top, k, k)
+
+    def between(self, low: int, high: int) -> Iterator[Pattern]:
+        start = bisect.bisect_left(self.sums, low)
+        end = bisect.bisect_right(self.sums, high)
+        for position in range(start * self.k, end * self.k, self.k):
+            yield tuple(self.patterns[position:position + self.k])
+
+
+def _patterns_from(first: int, values: array, caps: array, required: array, window: Window) -> list[Pattern]:
+    """Patterns whose smallest denomination index is `first`, run in a pool worker."""
+    suffix = [
+        Denomination(key=index, value=values[index], cap=caps[index], required=required[index])
+        for index in range(first, len(values))
+    ]
+    suffix[0] = replace(suffix[0], required=max(suffix[0].required, 1))
+    return [tuple(first + i for i in pattern) for pattern in multisets(suffix, window)]
+
+
+@functools.cache
+def _pool() -> ProcessPoolExecutor:
+    """The pool of this process, shared by all searches and capped by COMBINATION_PARALLEL_WORKERS."""
+    from stamp_assist.settings import env
+
+    return ProcessPoolExecutor(
+        max_workers=min(env('COMBINATION_PARALLEL_WORKERS'), os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+def parallel(denominations: list[Denomination], window: Window) -> Iterator[Pattern]:
+    """
+    Same patterns as multisets(), searched in a process pool.
+
+    The search space is split by the smallest denomination of a pattern: one
+    task per denomination, no required stamps may come before it. Workers get
+    plain value arrays rather than models, and results are merged in task
+    order, so the output is the same for any number of workers.
+
+    Inside a pool process (a combination job) the search runs in place, so
+    every web worker has at most one pool and pools never nest.
+    """
+    if multiprocessing.parent_process() is not None or count(denominations, window) < PARALLEL_THRESHOLD:
+        yield from multisets(denominations, window)
+        return
+
+    values = array('q', (x.value for x in denominations))
+    caps = array('q', (x.cap for x in denominations))
+    required = array('q', (x.required for x in denominations))
+
+    firsts = []
+    for index, denomination in enumerate(denominations):
+        firsts.append(index)
+        if denomination.required:
+            break
+
+    if not window.k_min and not any(required) and window.low <= 0 <= window.high:
+        yield ()
+    search = functools.partial(_patterns_from, values=values, caps=caps, required=required, window=window)
+    for patterns in _pool().map(search, firsts):
+        yield from patterns
+
+
+def anchored(
+        search: Search,
+        denominations: list[Denomination],
+        window: Window,
+) -> Iterator[Pattern]:
+    """
+    Run a search with the postcard stamps fixed up front.
+
+    Their value is taken off the window and their number off the stamp range,
+    so the search only enumerates what is left to add, instead of throwing
+    away every combination that misses a postcard stamp.
+    """
+    fixed = tuple(index for index, x in enumerate(denominations) for _ in range(x.required))
+    if not fixed:
+        yield from search(denominations, window)
+        return
+
+    fixed_sum = sum(denominations[i].value for i in fixed)
+    if (
+            len(fixed) > window.k_max
+            or fixed_sum > window.high
+            or any(x.required > x.cap for x in denominations)
+    ):
+        return
+
+    rest = [replace(x, cap=x.cap - x.required, required=0) for x in denominations]
+    rest_window = Window(
+        low=window.low - fixed_sum,
+        high=window.high - fixed_sum,
+        k_min=max(window.k_min - len(fixed), 0),
+        k_max=window.k_max - len(fixed),
+    )
+    for pattern in search(rest, rest_window):
+        yield tuple(sorted(fixed + pattern))
+
+
+def update(
+        search: Search,
+        previous: list[Denomination],
+        patterns: list[Pattern],
+        denominations: list[Denomination],
+        window: Window,
+) -> list[Pattern] | None:
+    """
+    Patterns for the new denominations, derived from the previous result.
+
+    Works when the copies of a single denomination changed (a stamp moved
+    to the postcard, a sample was removed or restored), otherwise returns
+    None. Previous patterns that still fit the new copy range of that
+    denomination are kept, and only patterns with the newly allowed numbers
+    of copies are searched for. A changed value moves sums in or out of the
+    window, so it always needs a full search.
+    """
+    before = {x.key: x for x in previous}
+    after = {x.key: x for x in denominations}
+    changed = [key for key in before.keys() | after.keys() if before.get(key) != after.get(key)]
+    if not changed:
+        return patterns
+    if len(changed) > 1:
+        return None
+
+    key = changed[0]
+    if key in before and key in after and before[key].value != after[key].value:
+        return None
+    old_required, old_cap = (before[key].required, before[key].cap) if key in before else (0, 0)
+    new_required, new_cap = (after[key].required, after[key].cap) if key in after else (0, 0)
+
+    position = {x.key: index for index, x in enumerate(denominations)}
+    old_index = next((index for index, x in enumerate(previous) if x.key == key), None)
+    result = [
+        tuple(sorted(position[previous[i].key] for i in pattern))
+        for pattern in patterns
+        if new_required <= pattern.count(old_index) <= new_cap
+    ]
+
+    for low, high in ((new_required, min(new_cap, old_required - 1)), (max(new_required, old_cap + 1), new_cap)):
+        if low > high:
+            continue
+        variant = list(denominations)
+        if key in position:
+            variant[position[key]] = replace(after[key], required=low, cap=high)
+        result.extend(anchored(search, variant, window))
+
+    return result
+
+
+def _value(pattern: Pattern, denominations: list[Denomination]) -> int:
+    return sum(denominations[i].value for i in pattern)
+
+
+def least_overpay(pattern: Pattern, denominations: list[Denomination]) -> tuple:
+    return _value(pattern, denominations), len(pattern)
+
+
+def fewest_stamps(pattern: Pattern, denominations: list[Denomination]) -> tuple:
+    return len(pattern), _value(pattern, denominations)
+
+
+def most_duplicated(pattern: Pattern, denominations: list[Denomination]) -> tuple:
+    """Most spare copies used up first: owned copies beyond the first one of every stamp in the pattern."""
+    return -sum(max(denominations[i].copies - 1, 0) for i in pattern), _value(pattern, denominations)
+
+
+def top(
+        patterns: Iterable[Pattern],
+        denominations: list[Denomination],
+        objective: Objective,
+        k: int,
+        tie_break: Objective = least_overpay,
+) -> list[Pattern]:
+    """
+    The k best patterns, smallest objective key first, then smallest
+    tie_break key, then the pattern itself so the order is total.
+
+    Only k patterns are held at a time (heapq.nsmallest keeps a bounded
+    heap), so the stream is never materialized.
+    """
+    return heapq.nsmallest(
+        k,
+        patterns,
+        key=lambda pattern: (objective(pattern, denominations), tie_break(pattern, denominations), pattern),
+    )
+
+
+def leading(
+        patterns: Iterable[Pattern],
+        denominations: list[Denomination],
+        objective: Objective,
+        k: int,
+) -> list[Pattern]:
+    """
+    The k best patterns of a stream already sorted by the objective, ranked
+    like top(). Patterns are taken until there are k and the objective key
+    changes, so ties with the k-th one are ranked too, and the rest of the
+    stream is never generated.
+    """
+    taken = []
+    for pattern in patterns:
+        if len(taken) >= k and (not taken or objective(pattern, denominations) != objective(taken[-1], denominations)):
+            break
+        taken.append(pattern)
+    return top(taken, denominations, objective, k)
+
+
+OBJECTIVES: dict[str, Objective] = {
+    'overpay': least_overpay,
+    'stamps': fewest_stamps,
+    'duplicates': most_duplicated,
+}
+
+STRATEGIES: dict[str, Search] = {
+    'search': multisets,
+    'mitm': meet_in_the_middle,
+    'parallel': parallel,
+    'numpy': vectorized,
+}
+DEFAULT_STRATEGY = 'mitm'
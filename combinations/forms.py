@@ -1,6 +1,7 @@
 from django import forms
 
 from combinations.models import StampSample, UserStamp
+from stamp_assist.settings import env
 
 STAMPS_COUNT_CHOICES = (
     (1, 1),
@@ -10,12 +11,14 @@ STAMPS_COUNT_CHOICES = (
     (5, 5),
 )
 
+MAX_VALUE = env('COMBINATION_MAX_VALUE')  # the combination search grows with the upper bound
+
 
 class CalcConfigForm(forms.Form):
     stamps_min = forms.ChoiceField(choices=STAMPS_COUNT_CHOICES)
     stamps_max = forms.ChoiceField(choices=STAMPS_COUNT_CHOICES)
-    target_value = forms.DecimalField(max_digits=10, decimal_places=2)
-    max_value = forms.DecimalField(max_digits=10, decimal_places=2)
+    target_value = forms.DecimalField(max_digits=10, decimal_places=2, min_value=0, max_value=MAX_VALUE)
+    max_value = forms.DecimalField(max_digits=10, decimal_places=2, min_value=0, max_value=MAX_VALUE)
 
 
 class ColnectCreateForm(forms.Form):
@@ -37,11 +40,8 @@ class UserStampCreateForm(forms.Form):
         user = kwargs.pop('user', None)
         super().__init__(*args, **kwargs)
         if user is not None:
-            user_stamps = user.stamps.all().prefetch_related('sample')
-            user_sample_ids = list(set(x.sample.id for x in user_stamps))
             self.fields['sample'].queryset = StampSample.objects \
-                .all() \
-                .exclude(id__in=user_sample_ids) \
+                .exclude(id__in=user.stamps.values('sample_id')) \
                 .order_by('name')
 
 
@@ -58,5 +58,5 @@ class UserStampAddForm(forms.Form):
     original_name = forms.CharField(max_length=255, disabled=True, required=False)
     custom_name = forms.CharField(max_length=255, required=False)
     comment = forms.CharField(max_length=255, required=False)
-    quantity = forms.IntegerField(initial=1, max_value=99, required=True)
+    quantity = forms.IntegerField(initial=1, min_value=1, max_value=99, required=True)
     allow_repeat = forms.BooleanField(initial=False, required=False)
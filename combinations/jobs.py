@@ -0,0 +1,64 @@
+"""
+Combination jobs run outside the request.
+
+The job rows live in the database (CombinationJob), so any worker can report
+on them; the computation runs in a process pool local to the web worker that
+enqueued it, so no broker is needed. A job lost with a restarted worker stops
+reporting and is replaced on the next visit (see CombinationJobManager.enqueue).
+"""
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+import django
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+
+from stamp_assist.settings import env
+
+logger = getLogger()
+
+
+@functools.cache
+def _pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=env('COMBINATION_JOB_WORKERS'),
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    )
+
+
+def submit(job_id: int):
+    _pool().submit(_run, job_id)
+
+
+def run(job_id: int):
+    """Compute the combinations of a job's user into the cache, reporting progress on the job row."""
+    from .models import CombinationJob, CombinationsPending, Desk, DeskType, JobStatus
+
+    jobs = CombinationJob.objects.filter(id=job_id)
+    jobs.report(status=JobStatus.RUNNING)
+    desk = Desk.objects.get(user__combination_jobs__id=job_id, type=DeskType.AVAILABLE)
+
+    try:
+        while True:
+            try:
+                result = desk.combinations(progress=lambda examined: jobs.report(examined=examined))
+                break
+            except CombinationsPending:
+                jobs.report()  # still alive, waiting for another worker computing the same result
+    except ValidationError as e:
+        jobs.report(status=JobStatus.FAILED, error=e.message)
+    except Exception as e:
+        logger.exception(f'Combination job {job_id} failed')
+        jobs.report(status=JobStatus.FAILED, error=str(e))
+    else:
+        jobs.report(status=JobStatus.DONE, examined=len(result))
+
+
+def _run(job_id: int):
+    try:
+        run(job_id)
+    finally:
+        close_old_connections()
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management import BaseCommand
+
+from accounts.models import User
+from combinations.engine import STRATEGIES
+from combinations.models import Desk
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('username', type=str)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        user = User.objects.get(username=options['username'])
+        desk = Desk.desk_available(user)
+        denominations, _ = desk.inventory()
+        window = desk.window()
+
+        for name, search in STRATEGIES.items():
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                found = sum(1 for _ in search(denominations, window))
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write(f'{name}: {found} combinations, best of {options["repeat"]}: {min(timings):.4f} s')
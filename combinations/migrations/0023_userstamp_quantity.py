@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:53
+
+from django.db import migrations, models
+
+
+def merge_copies(apps, schema_editor):
+    """Turn the rows of every user, sample and desk into one lot; the first row's fields are kept."""
+    UserStamp = apps.get_model('combinations', 'UserStamp')
+    lots = UserStamp.objects \
+        .values('user_id', 'sample_id', 'desk_id') \
+        .annotate(first=models.Min('id'), copies=models.Count('id')) \
+        .filter(copies__gt=1) \
+        .order_by()
+    for lot in lots.iterator():
+        UserStamp.objects.filter(id=lot['first']).update(quantity=lot['copies'])
+        UserStamp.objects \
+            .filter(user_id=lot['user_id'], sample_id=lot['sample_id'], desk_id=lot['desk_id']) \
+            .exclude(id=lot['first']) \
+            .delete()
+
+
+def split_lots(apps, schema_editor):
+    UserStamp = apps.get_model('combinations', 'UserStamp')
+    for lot in UserStamp.objects.filter(quantity__gt=1).iterator():
+        UserStamp.objects.bulk_create(
+            UserStamp(
+                user_id=lot.user_id,
+                sample_id=lot.sample_id,
+                desk_id=lot.desk_id,
+                custom_name=lot.custom_name,
+                comment=lot.comment,
+                allow_repeat=lot.allow_repeat,
+            )
+            for _ in range(lot.quantity - 1)
+        )
+    UserStamp.objects.update(quantity=1)
+    schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')  # check the new rows before the column is dropped
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('combinations', '0022_combinationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userstamp',
+            name='quantity',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(merge_copies, split_lots),
+        migrations.AddConstraint(
+            model_name='userstamp',
+            constraint=models.UniqueConstraint(fields=('user', 'sample', 'desk'), name='unique_user_stamp_lot'),
+        ),
+    ]
@@ -1,30 +1,38 @@
 import datetime
+import hashlib
 import itertools
-import math
 import random
+import sys
 import time
-from dataclasses import dataclass
+from contextlib import contextmanager
+from array import array
+from dataclasses import dataclass, field, replace
 from decimal import Decimal
-from functools import wraps
+from functools import partial, wraps
 from logging import getLogger
 from pathlib import Path
-from typing import Self
+from typing import Callable, Iterator, Self
 
 import requests
 from bs4 import BeautifulSoup
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from django.utils import timezone
 from django.utils.text import slugify
 from imagekitio import ImageKit
 from imagekitio.models.UploadFileRequestOptions import UploadFileRequestOptions
-from mimesis import Text, Locale, Datetime, Address, Finance, BinaryFile
+from mimesis import Text, Locale, Datetime, Address, Finance, Internet
 
 from accounts.models import User
 from stamp_assist.settings import env
+from . import jobs, prewarm
+from .cache import LocalCache
+from .engine import DEFAULT_STRATEGY, OBJECTIVES, STRATEGIES, Denomination, Pattern, Search, SumIndex, SumTable, \
+    Window, anchored, budgeted, count, digest, leading, multisets, ordered, to_cents, top, update
 
 imagekit = ImageKit(
     private_key=env('IMAGE_KIT_PRIVATE_KEY'),
@@ -38,21 +46,110 @@ mim_text_en = Text(locale=Locale.EN)
 mim_datetime = Datetime()
 mim_address_en = Address(locale=Locale.EN)
 mim_finance = Finance()
-mim_binary_file = BinaryFile()
+mim_internet = Internet()
+
+
+COMBINATION_OVERHEAD = 250  # bytes of a Combination with its two arrays, without the items
+JOB_STALE_AFTER = 600  # seconds without progress after which a job is considered lost
+PROGRESS_EVERY = 10_000  # patterns between progress reports
+COMBINATION_LOCK_POLL = 0.2  # seconds between cache checks while another worker computes
+ANYTIME_TABLE_LIMIT = 50_000_000  # SumTable cells (about 0.3 s) built before an anytime search; more go to a job
+FINGERPRINT_TIMEOUT = 60  # seconds an inventory fingerprint is trusted without a change signal
+
+inventory_changed = Signal()  # sent with user_id when stamps of a user are changed in bulk
+
+
+local_cache = LocalCache(env('COMBINATION_LOCAL_ENTRIES'), env('COMBINATION_LOCAL_BYTES'))
+
+
+def result_size(combinations: list['Combination']) -> int:
+    """Rough memory footprint of a combinations list, for the local cache limit."""
+    return sys.getsizeof(combinations) + sum(
+        COMBINATION_OVERHEAD + comb.stamp_ids.itemsize * len(comb.stamp_ids) * 2 for comb in combinations
+    )
+
+
+def search_strategy(name: str | None = None) -> Search:
+    """
+    The engine search named by name, or by COMBINATION_STRATEGY when no name
+    is given. An unknown name raises ValueError, except in the setting, where
+    the default search is used with a warning rather than failing every request.
+    """
+    if name is not None:
+        if name not in STRATEGIES:
+            raise ValueError(f'Unknown combination strategy {name!r}')
+        return STRATEGIES[name]
+
+    name = env('COMBINATION_STRATEGY')
+    if name not in STRATEGIES:
+        logger.warning(f'Unknown COMBINATION_STRATEGY {name!r}, using {DEFAULT_STRATEGY!r}')
+        name = DEFAULT_STRATEGY
+    return STRATEGIES[name]
+
+
+def reporting(patterns: Iterator[Pattern], progress: Callable[[int], None]) -> Iterator[Pattern]:
+    """Pass patterns through, calling progress with the count every PROGRESS_EVERY patterns."""
+    for n, pattern in enumerate(patterns, 1):
+        if n % PROGRESS_EVERY == 0:
+            progress(n)
+        yield pattern
+
+
+class CombinationsPending(ValidationError):
+    """Another worker is still computing the same combinations."""
+
+
+@contextmanager
+def advisory_lock(key: str) -> Iterator[bool]:
+    """Try to take a Postgres session advisory lock named by key; yields whether it was taken."""
+    lock_id = int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_id])
+        acquired = cursor.fetchone()[0]
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+
+
+def cached(cache_key: str, size: Callable = result_size):
+    """The result under cache_key from the local tier, or from the shared one (kept locally from then on)."""
+    result = local_cache.get(cache_key)
+    if result is None:
+        result = cache.get(cache_key)
+        if result is not None:
+            local_cache.set(cache_key, result, size=size(result))
+    return result
 
 
 def cache_combinations(func):
+    """
+    Cache the result per desk key and compute it single-flight: while one
+    worker holds the lock the others poll the cache for its result, and give
+    up with CombinationsPending after COMBINATION_LOCK_WAIT seconds.
+    """
     @wraps(func)
-    def wrapper(*args, **kwargs):
-        cache_key = f'combinations:{args[0].id}'  # Assuming args[0] is an instance of Desk
-        cached_result = cache.get(cache_key)
-
-        if cached_result is not None:
-            return cached_result
-        else:
-            result = func(*args, **kwargs)
-            cache.set(cache_key, result, timeout=3600)  # Cache for 1 hour
-            return result
+    def wrapper(desk, *args, **kwargs):
+        cache_key = desk.cache_key()
+        deadline = time.monotonic() + env('COMBINATION_LOCK_WAIT')
+        while True:
+            cached_result = cached(cache_key)
+            if cached_result is not None:
+                return cached_result
+
+            with advisory_lock(cache_key) as acquired:
+                if acquired:
+                    cached_result = cache.get(cache_key)  # stored while we waited for the lock
+                    if cached_result is None:
+                        cached_result = func(desk, *args, **kwargs)
+                        cache.set(cache_key, cached_result, timeout=3600)  # Cache for 1 hour
+                    local_cache.set(cache_key, cached_result, size=result_size(cached_result))
+                    return cached_result
+
+            if time.monotonic() >= deadline:
+                raise CombinationsPending('Combinations are being calculated, refresh the page in a moment')
+            time.sleep(COMBINATION_LOCK_POLL)
 
     return wrapper
 
@@ -78,84 +175,349 @@ class Desk(models.Model):
     def __repr__(self):
         return f'{self.type.capitalize()} ({self.user.username})'
 
+    @classmethod
+    def desks(cls, user: User) -> dict[str, Self]:
+        """
+        All desks of the user by type, loaded with one query and memoized on
+        the user object, so a request looks them up only once.
+        """
+        desks = getattr(user, '_desks', None)
+        if desks is None:
+            desks = {desk.type: desk for desk in cls.objects.filter(user=user)}
+            for desk in desks.values():
+                desk.user = user
+            user._desks = desks
+        return desks
+
     @classmethod
     def desk_available(cls, user: User) -> Self:
-        return cls.objects.get(user=user, type=DeskType.AVAILABLE)
+        return cls.desks(user)[DeskType.AVAILABLE]
 
     @classmethod
     def desk_postcard(cls, user: User) -> Self:
-        return cls.objects.get(user=user, type=DeskType.POSTCARD)
+        return cls.desks(user)[DeskType.POSTCARD]
 
     @classmethod
     def desk_removed(cls, user: User) -> Self:
-        return cls.objects.get(user=user, type=DeskType.REMOVED)
+        return cls.desks(user)[DeskType.REMOVED]
+
+    def fingerprint(self) -> str:
+        """
+        Digest of the user's stamps: their samples, values, desks, repeat flags and quantities.
+
+        Kept in the cache until a signal reports a change of the inventory, so
+        it is recomputed only after something has actually changed, or at the
+        latest after FINGERPRINT_TIMEOUT: a request that read the rows just
+        before a commit may store the old fingerprint after it was forgotten.
+        """
+        cache_key = f'inventory-fingerprint:{self.user_id}'
+        fingerprint = cache.get(cache_key)
+
+        if fingerprint is None:
+            rows = UserStamp.objects \
+                .filter(user_id=self.user_id) \
+                .order_by('id') \
+                .values_list('id', 'sample_id', 'sample__value', 'desk_id', 'allow_repeat', 'quantity')
+            fingerprint = hashlib.sha1(repr(list(rows)).encode()).hexdigest()
+            cache.set(cache_key, fingerprint, timeout=FINGERPRINT_TIMEOUT)
+
+        return fingerprint
+
+    def cache_key(self) -> str:
+        """Combinations cache key: the inventory fingerprint plus the calculation settings."""
+        settings_digest = hashlib.sha1(repr((self.window(), self.user.allow_stamp_repeat)).encode()).hexdigest()
+        return f'combinations:{self.user_id}:{self.fingerprint()}:{settings_digest}'
+
+    def cached_combinations(self) -> list['Combination'] | None:
+        """The combinations if they are cached already, without computing them."""
+        return cached(self.cache_key())
 
     def clear_cache(self):
-        cache_key = f'combinations:{self.id}'  # Assuming args[0] is an instance of Desk
+        cache_key = self.cache_key()
         cache.delete(cache_key)
+        local_cache.delete(cache_key)
+
+    def inventory(self) -> tuple[list[Denomination], dict[int, list[int]]]:
+        """
+        Group the user's stamps (except removed ones) by sample.
+
+        Returns denominations sorted by value and the stamp ids of every sample,
+        postcard ones first, so a pattern can be mapped back onto real stamps.
+        A lot's id is repeated once per copy, up to the most stamps a
+        combination can take.
+        """
+        postcard = self.desk_postcard(self.user)
+        rows_by_sample = {}
+        for row in UserStamp.objects \
+                .filter(user=self.user) \
+                .exclude(desk=self.desk_removed(self.user)) \
+                .order_by('id') \
+                .values_list('id', 'sample_id', 'sample__value', 'desk_id', 'allow_repeat', 'quantity'):
+            rows_by_sample.setdefault(row[1], []).append(row)
+
+        denominations = []
+        stamps_by_sample = {}
+        for sample_id, rows in rows_by_sample.items():
+            rows.sort(key=lambda x: x[3] != postcard.id)
+            stamps_by_sample[sample_id] = list(itertools.islice(
+                (stamp_id for stamp_id, *_, quantity in rows for _ in range(quantity)),
+                self.user.stamps_max,
+            ))
+            copies = sum(quantity for *_, quantity in rows)
+            if self.user.allow_stamp_repeat:
+                cap = copies
+            else:
+                repeatable = sum(quantity for *_, allow_repeat, quantity in rows if allow_repeat)
+                cap = repeatable + (repeatable < copies)
+
+            denominations.append(Denomination(
+                key=sample_id,
+                value=to_cents(rows[0][2]),
+                cap=cap,
+                required=sum(quantity for _, _, _, desk_id, _, quantity in rows if desk_id == postcard.id),
+                copies=copies,
+            ))
+
+        denominations.sort(key=lambda x: (x.value, x.cap, x.required, x.key))
+        return denominations, stamps_by_sample
+
+    def window(self) -> Window:
+        return Window(
+            low=to_cents(self.user.target_value),
+            high=to_cents(self.user.max_value),
+            k_min=self.user.stamps_min,
+            k_max=self.user.stamps_max,
+        )
+
+    def combinations_count(self) -> int:
+        """
+        Exact number of combinations in the value window, without enumerating them.
+
+        Cached next to the combinations it counts, as the counting DP grows
+        with the upper bound of the window.
+        """
+        cache_key = f'{self.cache_key()}:count'
+        total = cache.get(cache_key)
+
+        if total is None:
+            denominations, _ = self.inventory()
+            total = count(denominations, self.window())
+            cache.set(cache_key, total, timeout=3600)
+
+        return total
+
+    def sum_table(self, denominations: list[Denomination], window: Window, build: bool = True) -> SumTable | None:
+        """
+        The table ordered() starts from, for the current inventory and window.
+
+        Kept in both cache tiers, so paging through the combinations or
+        answering within a budget does not build it again for every request.
+        None if it is not cached and build is false.
+        """
+        cache_key = f'{self.cache_key()}:sums'
+        table = cached(cache_key, size=SumTable.nbytes)
+
+        if table is None and build:
+            table = SumTable.build(denominations, window)
+            cache.set(cache_key, table, timeout=3600)
+            local_cache.set(cache_key, table, size=table.nbytes())
+
+        return table
+
+    def ordered_combinations(self) -> 'OrderedCombinations':
+        """Combinations in ascending sum order, enumerated only for the requested slice."""
+        denominations, stamps_by_sample = self.inventory()
+        window = self.window()
+        return OrderedCombinations(
+            denominations,
+            stamps_by_sample,
+            window,
+            total=self.combinations_count(),
+            table=self.sum_table(denominations, window) if window.high >= 0 else None,
+        )
+
+    def anytime_combinations(self, seconds: float | None = None, limit: int | None = None) -> 'PartialCombinations':
+        """
+        The best combinations - nearest to the target value, then with fewer
+        stamps - that are found within a time (seconds) or work (limit) budget.
+        Not cached, as a different budget may give a different result.
+
+        The budget starts once ordered() has its table. Building it cannot be
+        cut short, so it is only done here while it is below
+        ANYTIME_TABLE_LIMIT cells; past that, unless the table is cached,
+        nothing is returned and the result is left to a job.
+        """
+        denominations, stamps_by_sample = self.inventory()
+        window = self.window()
+        if window.high < 0:
+            return PartialCombinations([], exhaustive=True)
+
+        table = self.sum_table(
+            denominations,
+            window,
+            build=SumTable.cells(denominations, window) <= ANYTIME_TABLE_LIMIT,
+        )
+        if table is None:
+            return PartialCombinations([], exhaustive=False)
+
+        patterns, exhaustive = budgeted(ordered(denominations, window, table=table), seconds, limit)
+        return PartialCombinations(
+            [Combination.from_pattern(pattern, denominations, stamps_by_sample) for pattern in patterns],
+            exhaustive=exhaustive,
+        )
+
+    def top_combinations(
+            self,
+            objective: str = 'overpay',
+            k: int = 10,
+            strategy: str | None = None,
+            seconds: float | None = None,
+    ) -> 'PartialCombinations':
+        """
+        The k best combinations by one of engine.OBJECTIVES, best first.
+
+        Patterns already solved for the same problem are ranked from the
+        shared cache; otherwise the search is streamed through a bounded heap.
+        Past COMBINATION_LIMIT combinations, 'overpay' and 'stamps' take the
+        first patterns of ordered(), which yields them in the objective's own
+        order (by sum, then number of stamps; or one number of stamps after
+        another), so only those are enumerated. No stream is ordered by spare
+        copies, so for 'duplicates' only the patterns the depth-first search
+        finds within a time budget (seconds, COMBINATION_BUDGET by default)
+        are ranked, and the result is not exhaustive.
+        """
+        denominations, stamps_by_sample = self.inventory()
+        window = self.window()
+        patterns = cache.get(f'combinations-shared:{digest(denominations, window)}')
+        exhaustive = True
+        if patterns is None:
+            if self.combinations_count() <= env('COMBINATION_LIMIT'):
+                patterns = anchored(search_strategy(strategy), denominations, window)
+            elif objective == 'duplicates':
+                # multisets() yields as it goes, so the budget can cut it short
+                patterns, exhaustive = budgeted(
+                    anchored(multisets, denominations, window),
+                    seconds=env('COMBINATION_BUDGET') if seconds is None else seconds,
+                )
+            else:
+                table = self.sum_table(denominations, window)
+                if objective == 'overpay':
+                    windows = [window]
+                else:
+                    windows = [replace(window, k_min=n, k_max=n) for n in range(window.k_min, window.k_max + 1)]
+                streams = (ordered(denominations, x, table=table) for x in windows)
+                patterns = leading(itertools.chain.from_iterable(streams), denominations, OBJECTIVES[objective], k)
+
+        return PartialCombinations(
+            [
+                Combination.from_pattern(pattern, denominations, stamps_by_sample)
+                for pattern in top(patterns, denominations, OBJECTIVES[objective], k)
+            ],
+            exhaustive=exhaustive,
+        )
+
+    def sum_index(self, denominations: list[Denomination], k: int) -> SumIndex | None:
+        """
+        Window-independent index of k-stamp sums for the current inventory.
+
+        Kept in the cache under a digest of the denominations, so it is rebuilt
+        only when the inventory changes and is shared by users with the same
+        denominations. None when the inventory has more than
+        COMBINATION_INDEX_LIMIT patterns of k stamps.
+        """
+        cache_key = f'combinations-index:{k}:{digest(denominations)}'
+        index = cache.get(cache_key)
+
+        if index is None:
+            if SumIndex.size(denominations, k) > env('COMBINATION_INDEX_LIMIT'):
+                index = False
+            else:
+                index = SumIndex.build(denominations, k)
+            cache.set(cache_key, index, timeout=None)
+
+        return index or None
+
+    def indexed(self, search: Search) -> Search:
+        """Wrap a search so that every stamp number with an index is a range query."""
+        def indexed_search(denominations: list[Denomination], window: Window) -> Iterator[Pattern]:
+            for k in range(window.k_min, window.k_max + 1):
+                if k and (index := self.sum_index(denominations, k)):
+                    yield from index.between(window.low, window.high)
+                else:
+                    yield from search(denominations, replace(window, k_min=k, k_max=k))
+
+        return indexed_search
+
+    def patterns(
+            self,
+            search: Search,
+            denominations: list[Denomination],
+            window: Window,
+            progress: Callable[[int], None] | None = None,
+    ) -> list[Pattern]:
+        """
+        Patterns for the inventory, updated incrementally from the last result when possible.
+
+        The denominations of the last result are kept with the key of its
+        patterns in the shared cache, so moving a single stamp or sample only
+        searches for what has changed. Otherwise the patterns are looked up
+        in the cache shared by all users, keyed by the problem without sample
+        ids, and searched for only when no user has solved the same problem
+        yet. A full search reports the number of patterns found so far to
+        progress.
+        """
+        state_key = f'combinations-last:{self.id}'
+        shared_key = f'combinations-shared:{digest(denominations, window)}'
+        state = cache.get(state_key)
+        previous = cache.get(state['shared_key']) if state is not None and state['window'] == window else None
+
+        patterns = None
+        if previous is not None:
+            patterns = update(search, state['denominations'], previous, denominations, window)
+            if patterns is not None and patterns is not previous:
+                logger.info(f'Updated combinations of {self.user.username} incrementally')
+                cache.set(shared_key, patterns, timeout=86400)
+
+        if patterns is None:
+            patterns = cache.get(shared_key)
+
+        if patterns is None:
+            if env('COMBINATION_INDEX_LIMIT'):
+                search = self.indexed(search)
+            patterns = anchored(search, denominations, window)
+            patterns = list(reporting(patterns, progress) if progress else patterns)
+            cache.set(shared_key, patterns, timeout=86400)
+
+        cache.set(state_key, {
+            'denominations': denominations,
+            'window': window,
+            'shared_key': shared_key,
+        }, timeout=3600)
+        return patterns
 
     @cache_combinations
-    def combinations(self):
+    def combinations(self, strategy: str | None = None, progress: Callable[[int], None] | None = None):
         start = time.perf_counter()
+        search = search_strategy(strategy)
 
-        if self.user.allow_stamp_repeat:
-            all_stamps = list(
-                UserStamp.objects
-                .filter(user=self.user)
-                .exclude(desk=self.desk_removed(self.user))
-                .prefetch_related('sample')
-            )
-        else:
-            all_stamps = []
-            added_samples = []
-            for stamp in UserStamp.objects \
-                    .filter(user=self.user) \
-                    .exclude(desk=self.desk_removed(self.user)) \
-                    .prefetch_related('sample'):
-
-                if stamp.allow_repeat:
-                    all_stamps.append(stamp)
-                elif stamp.sample not in added_samples:
-                    all_stamps.append(stamp)
-                    added_samples.append(stamp.sample)
-
-        combs_to_test = []
-        total_combs = 0
-
-        for st_num in range(self.user.stamps_min, self.user.stamps_max + 1):
-            total_combs += math.comb(len(all_stamps), st_num)
-            combs_to_test.append(itertools.combinations(all_stamps, st_num))
+        denominations, stamps_by_sample = self.inventory()
+        window = self.window()
 
+        total_combs = self.combinations_count()
         if total_combs > env('COMBINATION_LIMIT'):
             raise ValidationError(
                 'You have requested to calculate too much combinations. '
                 'Please, narrow the desired number of stamps.'
             )
 
-        logger.info(f'User {self.user.username} requested to evaluate {total_combs} combinations')
+        logger.info(f'User {self.user.username} requested {total_combs} combinations')
         t0 = time.perf_counter()
         logger.info(f'Preparation time: {t0 - start}')
 
-        filtered_by_value = (
-            comb for comb in itertools.chain(*combs_to_test)
-            if self.user.target_value <= sum(stamp.sample.value for stamp in comb) <= self.user.max_value
-        )
-
-        stamps_to_include = set(
-            x.id for x in UserStamp.objects.filter(
-                user=self.user, desk=self.desk_postcard(self.id)
-            )
-        )
-        added_combs = set()
-        result_combs = []
-        for comb in filtered_by_value:
-            if stamps_to_include and not set(x.id for x in comb).issuperset(stamps_to_include):
-                continue
-
-            comb_string = tuple(sorted(str(stamp) for stamp in comb))
-            if comb_string not in added_combs:
-                result_combs.append(Combination(comb))
-                added_combs.add(comb_string)
+        result_combs = [
+            Combination.from_pattern(pattern, denominations, stamps_by_sample)
+            for pattern in self.patterns(search, denominations, window, progress)
+        ]
 
         t1 = time.perf_counter()
         logger.info(f'Filtering time: {t1 - t0}')
@@ -163,7 +525,7 @@ class Desk(models.Model):
         logger.info(f'Resulting in {len(result_combs)} combinations')
         logger.info('= ' * 20)
 
-        return sorted(result_combs, key=lambda x: x.sum())
+        return sorted(result_combs, key=lambda x: x.total)
 
 
 class StampSampleManager(models.QuerySet):
@@ -222,17 +584,18 @@ class StampSampleManager(models.QuerySet):
 
     def generate(self, **kwargs):
         name = kwargs.get('name', mim_text_en.title())
+        value = kwargs.get('value', mim_finance.price(1, 101))
         return self.create(
             name=name,
-            slug=slugify(name),
+            slug=slugify(f'{name}-{value}'),
             year=kwargs.get('year', mim_datetime.year()),
             country=kwargs.get('country', mim_address_en.country()),
-            value=kwargs.get('value', mim_finance.price(1, 101)),
+            value=value,
             width=kwargs.get('width', random.randint(50, 400)),
             height=kwargs.get('height', random.randint(50, 400)),
             topics=kwargs.get('topics', mim_text_en.words(3)),
             michel_number=kwargs.get('michel_number', f'{mim_address_en.country_code()} {random.randint(1000, 9999)}'),
-            image=kwargs.get('image', mim_binary_file.image()),
+            image=kwargs.get('image', mim_internet.stock_image_url()),
         )
 
 
@@ -256,17 +619,163 @@ class StampSample(models.Model):
 
 
 class UserStampManager(models.QuerySet):
+    def update(self, **kwargs):
+        user_ids = set(self.order_by().values_list('user_id', flat=True).distinct())
+        updated = super().update(**kwargs)
+        for user_id in user_ids:
+            inventory_changed.send(sender=UserStamp, user_id=user_id)
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        for user_id in {stamp.user_id for stamp in created}:
+            inventory_changed.send(sender=UserStamp, user_id=user_id)
+        return created
+
+    # Inventory changes. Every one runs in a transaction with a fixed number
+    # of statements, whatever the quantity or the number of lots involved.
+
+    def add(self, *, user: User, sample: 'StampSample', desk: Desk, quantity: int = 1, **fields) -> 'UserStamp':
+        """
+        Add copies of a sample to the user's lot on desk, creating the lot
+        with fields (custom_name, comment, allow_repeat) if there is none.
+        Copies are taken off with remove(), not with a negative quantity.
+        """
+        if quantity < 1:
+            raise ValueError(f'Cannot add {quantity} copies')
+
+        with transaction.atomic():
+            lot, created = self.get_or_create(
+                user=user,
+                sample=sample,
+                desk=desk,
+                defaults={'quantity': quantity, **fields},
+            )
+            if not created:
+                lot.quantity = models.F('quantity') + quantity
+                lot.save(update_fields=['quantity'])
+                lot.refresh_from_db(fields=['quantity'])
+        return lot
+
+    def remove(self, quantity: int) -> int:
+        """
+        Remove up to quantity copies from these lots, oldest lot first: the
+        emptied lots with one DELETE, the rest taken from one more lot.
+        Returns the copies removed.
+        """
+        removed = 0
+        emptied, rest = [], None
+        with transaction.atomic():
+            for lot in self.select_for_update().order_by('id'):
+                if removed == quantity:
+                    break
+                taken = min(lot.quantity, quantity - removed)
+                if taken == lot.quantity:
+                    emptied.append(lot.id)
+                else:
+                    lot.quantity -= taken
+                    rest = lot
+                removed += taken
+
+            if emptied:
+                UserStamp.objects.filter(id__in=emptied).delete()
+            if rest is not None:
+                rest.save(update_fields=['quantity'])
+        return removed
+
+    def move_to(self, desk: Desk) -> int:
+        """
+        Move every copy in these lots onto desk, merged into one lot per
+        sample there. The lots that take the copies are updated in bulk and
+        the merged ones deleted at once. Returns the copies moved.
+        """
+        with transaction.atomic():
+            lots = list(self.exclude(desk=desk).select_for_update().order_by('id'))
+            moved = sum(lot.quantity for lot in lots)
+            targets = {
+                (lot.user_id, lot.sample_id): lot
+                for lot in UserStamp.objects.select_for_update().filter(
+                    desk=desk,
+                    user_id__in={lot.user_id for lot in lots},
+                    sample_id__in={lot.sample_id for lot in lots},
+                )
+            }
+            changed, merged = {}, []
+            for lot in lots:
+                target = targets.get((lot.user_id, lot.sample_id))
+                if target is None:
+                    lot.desk = desk
+                    targets[lot.user_id, lot.sample_id] = target = lot
+                else:
+                    target.quantity += lot.quantity
+                    merged.append(lot.id)
+                changed[target.id] = target
+
+            if merged:
+                UserStamp.objects.filter(id__in=merged).delete()
+            if changed:
+                UserStamp.objects.bulk_update(changed.values(), ['desk', 'quantity'])
+        return moved
+
+    def move_sample(self, user: User, sample: 'StampSample', desk: Desk) -> int:
+        """Move every copy of the user's sample onto desk."""
+        return self.filter(user=user, sample=sample).move_to(desk)
+
+    def reset(self, user: User) -> int:
+        """Move every copy of the user's stamps back onto the available desk."""
+        return self.filter(user=user).move_to(Desk.desk_available(user))
+
+    def stick(self, user: User) -> int:
+        """Take the stamps stuck onto the postcard out of the inventory. Returns the copies used."""
+        with transaction.atomic():
+            lots = list(self.select_for_update().filter(user=user, desk=Desk.desk_postcard(user)))
+            UserStamp.objects.filter(id__in=[lot.id for lot in lots]).delete()
+        return sum(lot.quantity for lot in lots)
+
+    def copies(self) -> int:
+        return self.aggregate(copies=models.Sum('quantity'))['copies'] or 0
+
     def generate(self, *, user: User, **kwargs):
-        desk = Desk.objects.get(user=user, type=DeskType.AVAILABLE)
-        return self.create(
+        return self.add(
+            user=user,
             sample=kwargs.get('sample', StampSample.objects.generate()),
+            desk=kwargs.get('desk', Desk.desk_available(user)),
+            quantity=kwargs.get('quantity', 1),
             custom_name=kwargs.get('custom_name'),
             comment=kwargs.get('comment'),
-            user=user,
-            desk=kwargs.get('desk', desk),
             allow_repeat=kwargs.get('allow_repeat', False),
         )
 
+    def grouped(self, after: tuple[Decimal, int] | None = None, limit: int = 60) -> list[dict]:
+        """
+        One entry per sample with the number of copies, ordered by sample value.
+
+        Copies are summed by the database, and the page is found by keyset
+        on (sample value, sample id): pass the value and sample id of the last
+        entry of the previous page as after. Every entry holds the fields of
+        the sample's first stamp, which stands for all of its copies.
+        """
+        groups = self \
+            .values('sample_id', 'sample__value') \
+            .annotate(quantity=models.Sum('quantity'), stamp_id=models.Min('id')) \
+            .order_by('sample__value', 'sample_id')
+        if after is not None:
+            value, sample_id = after
+            groups = groups.filter(
+                models.Q(sample__value__gt=value) | models.Q(sample__value=value, sample_id__gt=sample_id)
+            )
+        groups = list(groups[:limit])
+
+        stamps = UserStamp.objects.select_related('sample').in_bulk([group['stamp_id'] for group in groups])
+        return [{
+            'id': group['stamp_id'],
+            'sample': stamps[group['stamp_id']].sample,
+            'custom_name': stamps[group['stamp_id']].custom_name,
+            'comment': stamps[group['stamp_id']].comment,
+            'quantity': group['quantity'],
+            'allow_repeat': stamps[group['stamp_id']].allow_repeat,
+        } for group in groups]
+
     def to_json(self) -> list[dict]:
         return [{
             'sample_slug': stamp.sample.slug,
@@ -275,23 +784,53 @@ class UserStampManager(models.QuerySet):
             'username': stamp.user.username,
             'desk_type': stamp.desk.type,
             'allow_repeat': stamp.allow_repeat,
+            'quantity': stamp.quantity,
         } for stamp in self]
 
     def from_json(self, stamps_raw_data: list[dict]) -> list:
-        created_stamps = []
+        """
+        Import lots exported by to_json(), adding their copies to the lots
+        already there. Older exports without quantities have a row per copy.
+        """
+        users = {user.username: user for user in User.objects.filter(
+            username__in={stamp['username'] for stamp in stamps_raw_data},
+        )}
+        samples = {sample.slug: sample for sample in StampSample.objects.filter(
+            slug__in={stamp['sample_slug'] for stamp in stamps_raw_data},
+        )}
+
+        lots = {}
         for stamp in stamps_raw_data:
-            user = User.objects.get(username=stamp['username'])
-            created_stamp = self.create(
-                sample=StampSample.objects.get(slug=stamp['sample_slug']),
-                custom_name=stamp['custom_name'],
-                comment=stamp['comment'],
-                user=user,
-                desk=Desk.objects.get(user=user, type=stamp['desk_type']),
-                allow_repeat=stamp['allow_repeat'],
+            user = users[stamp['username']]
+            desk = Desk.desks(user)[stamp['desk_type']]
+            key = user.id, samples[stamp['sample_slug']].id, desk.id
+            if key not in lots:
+                lots[key] = UserStamp(
+                    user=user,
+                    sample=samples[stamp['sample_slug']],
+                    desk=desk,
+                    custom_name=stamp['custom_name'],
+                    comment=stamp['comment'],
+                    allow_repeat=stamp['allow_repeat'],
+                    quantity=0,
+                )
+            lots[key].quantity += stamp.get('quantity', 1)
+
+        with transaction.atomic():
+            existing = UserStamp.objects.select_for_update().filter(
+                user_id__in={user_id for user_id, _, _ in lots},
+                sample_id__in={sample_id for _, sample_id, _ in lots},
             )
-            created_stamps.append(created_stamp)
+            updated = []
+            for lot in existing:
+                key = lot.user_id, lot.sample_id, lot.desk_id
+                if key in lots:
+                    lot.quantity += lots.pop(key).quantity
+                    updated.append(lot)
 
-        return created_stamps
+            if updated:
+                UserStamp.objects.bulk_update(updated, ['quantity'])
+            return updated + UserStamp.objects.bulk_create(lots.values())
 
 
 class UserStamp(models.Model):
@@ -301,9 +840,15 @@ class UserStamp(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='stamps', on_delete=models.CASCADE)
     desk = models.ForeignKey(Desk, related_name='stamps', on_delete=models.PROTECT, null=True)
     allow_repeat = models.BooleanField(default=False)
+    quantity = models.PositiveIntegerField(default=1)
 
     objects = UserStampManager.as_manager()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'sample', 'desk'], name='unique_user_stamp_lot'),
+        ]
+
     def __add__(self, other) -> Decimal:
         if isinstance(other, self.__class__):
             return self.sample.value + other.sample.value
@@ -325,19 +870,147 @@ class UserStamp(models.Model):
         else:
             return f'id={self.id} value={self.sample.value}'
 
+    def move(self, desk: Desk, quantity: int = 1) -> Self:
+        """
+        Move copies of this lot onto desk, into the lot of the same sample
+        there if there is one. Returns the lot the copies ended up in; a lot
+        already on desk stays as it is.
+        """
+        with transaction.atomic():
+            lot = UserStamp.objects.select_for_update().get(id=self.id)
+            if lot.desk_id == desk.id:
+                return lot
+            quantity = min(quantity, lot.quantity)
+            target = UserStamp.objects \
+                .select_for_update() \
+                .filter(user_id=lot.user_id, sample_id=lot.sample_id, desk=desk) \
+                .first()
+
+            if target is None and quantity == lot.quantity:
+                lot.desk = desk
+                lot.save(update_fields=['desk'])
+                target = lot
+            else:
+                if target is None:
+                    target = UserStamp.objects.create(
+                        user_id=lot.user_id,
+                        sample_id=lot.sample_id,
+                        desk=desk,
+                        quantity=quantity,
+                        custom_name=lot.custom_name,
+                        comment=lot.comment,
+                        allow_repeat=lot.allow_repeat,
+                    )
+                else:
+                    target.quantity += quantity
+                    target.save(update_fields=['quantity'])
+
+                if quantity == lot.quantity:
+                    lot.delete()
+                    lot.quantity = 0
+                else:
+                    lot.quantity -= quantity
+                    lot.save(update_fields=['quantity'])
+
+        self.desk, self.quantity = lot.desk, lot.quantity
+        return target
+
     def to_available(self):
-        UserStamp.objects.filter(
-            user=self.user,
-            sample=self.sample,
-        ).update(desk=Desk.desk_available(self.user))
+        UserStamp.objects.move_sample(self.user, self.sample, Desk.desk_available(self.user))
 
     def to_postcard(self):
-        self.desk = Desk.desk_postcard(self.user.id)
-        self.save()
+        return self.move(Desk.desk_postcard(self.user))
 
     def to_removed(self):
-        self.desk = Desk.desk_removed(self.user.id)
-        self.save()
+        return self.move(Desk.desk_removed(self.user))
+
+
+class JobStatus(models.TextChoices):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class CombinationJobManager(models.QuerySet):
+    def enqueue(self, desk: Desk) -> 'CombinationJob':
+        """
+        Return the live job computing the desk's current combinations,
+        creating one and handing it to the worker pool if there is none.
+
+        Jobs that have not reported for JOB_STALE_AFTER seconds are treated
+        as lost with a restarted worker and are replaced.
+        """
+        cache_key = desk.cache_key()
+        job = self.filter(
+            user_id=desk.user_id,
+            cache_key=cache_key,
+            status__in=[JobStatus.QUEUED, JobStatus.RUNNING],
+            updated_at__gte=timezone.now() - datetime.timedelta(seconds=JOB_STALE_AFTER),
+        ).first()
+
+        if job is None:
+            job = self.create(user_id=desk.user_id, cache_key=cache_key, total=desk.combinations_count())
+            transaction.on_commit(partial(jobs.submit, job.id))
+        return job
+
+    def report(self, **fields):
+        return self.update(updated_at=timezone.now(), **fields)
+
+
+class CombinationJob(models.Model):
+    """A combinations computation run outside the request by the worker pool in combinations.jobs."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='combination_jobs', on_delete=models.CASCADE)
+    cache_key = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=JobStatus.choices, default=JobStatus.QUEUED)
+    examined = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = CombinationJobManager.as_manager()
+
+    def to_json(self) -> dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'examined': self.examined,
+            'total': self.total,
+            'error': self.error,
+        }
+
+
+@receiver([post_save, post_delete], sender='combinations.UserStamp')
+def user_stamp_changed(sender, instance=None, **kwargs):
+    inventory_changed.send(sender=sender, user_id=instance.user_id)
+
+
+@receiver(post_save, sender='combinations.StampSample')
+def stamp_sample_changed(sender, instance=None, created=False, **kwargs):
+    if not created:
+        for user_id in UserStamp.objects.filter(sample=instance).values_list('user_id', flat=True).distinct():
+            inventory_changed.send(sender=sender, user_id=user_id)
+
+
+@receiver(inventory_changed)
+def forget_fingerprint(sender, user_id=None, **kwargs):
+    # Once more after the commit: a concurrent request may have cached the
+    # fingerprint of the uncommitted state in between.
+    cache_key = f'inventory-fingerprint:{user_id}'
+    cache.delete(cache_key)
+    transaction.on_commit(partial(cache.delete, cache_key))
+
+
+@receiver(inventory_changed)
+def prewarm_after_inventory_change(sender, user_id=None, **kwargs):
+    transaction.on_commit(partial(prewarm.schedule, user_id))
+
+
+@receiver(post_save, sender=User)
+def prewarm_after_settings_change(sender, instance=None, created=False, **kwargs):
+    if not created:
+        transaction.on_commit(partial(prewarm.schedule, instance.id))
 
 
 @receiver(post_save, sender=User)
@@ -348,17 +1021,95 @@ def desk_create(sender, instance=None, created=False, **kwargs):
         Desk.objects.create(user=instance, type=DeskType.REMOVED)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Combination:
-    stamps: list[UserStamp]
+    """
+    A combination as stamp and sample ids with its sum in cents. Stamp ids
+    are lot ids, repeated when several copies of a lot are used.
 
-    def __eq__(self, other) -> bool:
-        if isinstance(other, self.__class__):
-            self_names = sorted([x.sample.name for x in self.stamps])
-            other_names = sorted([x.sample.name for x in other.stamps])
-            return self_names == other_names
+    That is all that is cached; the stamps themselves are loaded by
+    hydrate() for the combinations actually rendered.
+    """
+    stamp_ids: array
+    sample_ids: array
+    total: int
+    stamps: tuple[UserStamp, ...] = field(default=(), compare=False)
 
-        return NotImplemented
+    @classmethod
+    def from_pattern(
+            cls,
+            pattern: Pattern,
+            denominations: list[Denomination],
+            stamps_by_sample: dict[int, list[int]],
+    ) -> Self:
+        stamp_ids = array('Q')
+        for index, group in itertools.groupby(pattern):
+            stamp_ids.extend(stamps_by_sample[denominations[index].key][:len(list(group))])
+
+        return cls(
+            stamp_ids=stamp_ids,
+            sample_ids=array('Q', (denominations[index].key for index in pattern)),
+            total=sum(denominations[index].value for index in pattern),
+        )
+
+    @classmethod
+    def hydrate(cls, combinations: list[Self]) -> list[Self]:
+        """
+        Attach stamps with their samples to the combinations, in one query.
+
+        A cached combination may outlive a stamp deleted by another request;
+        combinations with stamps that are gone are dropped.
+        """
+        stamps = UserStamp.objects \
+            .select_related('sample') \
+            .in_bulk({stamp_id for comb in combinations for stamp_id in comb.stamp_ids})
+        return [
+            replace(comb, stamps=tuple(stamps[stamp_id] for stamp_id in comb.stamp_ids))
+            for comb in combinations
+            if all(stamp_id in stamps for stamp_id in comb.stamp_ids)
+        ]
 
     def sum(self) -> Decimal:
-        return sum(self.stamps)
+        return Decimal(self.total).scaleb(-2)
+
+
+class OrderedCombinations:
+    """
+    Lazy sequence of combinations in ascending sum order.
+
+    Its length is known from the counting DP, and slicing enumerates only the
+    requested combinations, so a Paginator can jump to any page.
+    """
+
+    def __init__(
+            self,
+            denominations: list[Denomination],
+            stamps_by_sample: dict[int, list[int]],
+            window: Window,
+            total: int | None = None,
+            table: SumTable | None = None,
+    ):
+        self.denominations = denominations
+        self.stamps_by_sample = stamps_by_sample
+        self.window = window
+        self.total = count(denominations, window) if total is None else total
+        self.table = table
+
+    def __len__(self) -> int:
+        return self.total
+
+    def __getitem__(self, item: slice) -> list[Combination]:
+        start, stop, _ = item.indices(self.total)
+        patterns = itertools.islice(ordered(self.denominations, self.window, start, self.table), max(stop - start, 0))
+        return [
+            Combination.from_pattern(pattern, self.denominations, self.stamps_by_sample)
+            for pattern in patterns
+        ]
+
+
+class PartialCombinations(list):
+    """Combinations found within a budget; exhaustive when they are all there are."""
+
+    def __init__(self, combinations: list[Combination], exhaustive: bool):
+        super().__init__(combinations)
+        self.exhaustive = exhaustive
@@ -0,0 +1,66 @@
+"""
+Background pre-warming of the combinations cache.
+
+When a user's inventory or calculation settings change, the new result is
+computed in a worker thread so the combinations page is ready when the user
+opens it. Jobs are deduplicated per user: a user already waiting in the queue
+is not queued again, and a job is queued only after a short delay, which lets
+a burst of changes (adding ten copies of a stamp) collapse into one
+computation. The delay runs on a timer, so it does not hold up the jobs of
+other users waiting for the worker.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+
+from stamp_assist.settings import env
+
+PREWARM_DELAY = 1  # seconds to wait for further changes before computing
+
+logger = getLogger()
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prewarm')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def schedule(user_id: int):
+    """Queue a pre-warm of the user's combinations unless one is already waiting."""
+    if not env('COMBINATION_PREWARM'):
+        return
+
+    with _pending_lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+    timer = threading.Timer(PREWARM_DELAY, _executor.submit, (_run, user_id))
+    timer.daemon = True
+    timer.start()
+
+
+def warm(user_id: int):
+    """Compute the user's combinations into the cache, if they are small enough to be listed."""
+    from .models import DeskType
+
+    desk = apps.get_model('combinations', 'Desk').objects.get(user_id=user_id, type=DeskType.AVAILABLE)
+    if desk.combinations_count() <= env('COMBINATION_LIMIT'):
+        try:
+            desk.combinations()
+        except ValidationError:
+            pass  # another worker is computing it already
+
+
+def _run(user_id: int):
+    with _pending_lock:
+        _pending.discard(user_id)  # changes from now on need a new job
+
+    try:
+        warm(user_id)
+    except Exception:
+        logger.exception(f'Pre-warming combinations of user {user_id} failed')
+    finally:
+        close_old_connections()
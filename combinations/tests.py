@@ -1,8 +1,37 @@
+import atexit
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+from dataclasses import replace
+from unittest import mock
+
 import django.test
 import pytest
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from accounts.models import User
-from .models import StampSample, UserStamp
+from . import engine, jobs, prewarm
+from .cache import EVICT_EVERY, CompressedFileCache, LocalCache
+from .engine import OBJECTIVES, STRATEGIES, Denomination, SumIndex, SumTable, Window, anchored, budgeted, count, \
+    least_overpay, multisets, ordered, parallel, top, update
+from .forms import UserStampCreateForm
+from .models import FINGERPRINT_TIMEOUT, Combination, CombinationJob, CombinationsPending, Desk, DeskType, JobStatus, \
+    StampSample, UserStamp, local_cache
+
+# Tests clear the cache, so they get their own instead of the configured one
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'combinations.cache.CompressedFileCache',
+        'LOCATION': tempfile.mkdtemp(prefix='stamp-assist-test-cache-'),
+    },
+}
+atexit.register(shutil.rmtree, TEST_CACHES['default']['LOCATION'], ignore_errors=True)
 
 
 @pytest.mark.skip('Skip for now')
@@ -27,7 +56,12 @@ def test_sample_stamp_create():
     assert len(StampSample.objects.all()) == 1
 
 
+@override_settings(CACHES=TEST_CACHES)
 class TestCombinations(django.test.TestCase):
+    def setUp(self):
+        cache.clear()  # the file cache outlives the test database
+        local_cache.clear()
+
     def test_single_stamp(self):
         user = User.objects.generate(target_value=10, max_value=10)
         sample = StampSample.objects.generate(value=10)
@@ -80,8 +114,728 @@ class TestCombinations(django.test.TestCase):
         combs = user.desk_available.combinations()
         assert len(combs) == 1
 
+    def test_copies_are_not_duplicated(self):
+        user = User.objects.generate(target_value=20, max_value=30, allow_stamp_repeat=True)
+
+        sample = StampSample.objects.generate(value=10)
+        for _ in range(20):
+            lot = UserStamp.objects.generate(user=user, sample=sample)
+
+        combs = user.desk_available.combinations()
+        assert [comb.sum() for comb in combs] == [20, 30]
+        assert [list(comb.stamp_ids) for comb in combs] == [[lot.id] * 2, [lot.id] * 3]
+
+    def test_cache_follows_inventory_and_settings(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=2, target_value=10, max_value=20)
+        sample = StampSample.objects.generate(value=10)
+        stamp = UserStamp.objects.generate(user=user, sample=sample)
+
+        desk = user.desk_available
+        assert len(desk.combinations()) == 1
+        first_key = desk.cache_key()
+
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=5))
+        assert len(desk.combinations()) == 2
+
+        UserStamp.objects.filter(id=stamp.id).update(desk=Desk.desk_removed(user))
+        assert len(desk.combinations()) == 0
+
+        UserStamp.objects.filter(sample__value=5).delete()
+        UserStamp.objects.filter(id=stamp.id).update(desk=desk)
+        assert desk.cache_key() == first_key
+
+    def test_fingerprint_is_forgotten_after_commit(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        desk = user.desk_available
+
+        with mock.patch.object(prewarm, 'schedule'), self.captureOnCommitCallbacks(execute=True):
+            UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+            stale = desk.fingerprint()  # a concurrent reader before the commit
+        assert cache.get(f'inventory-fingerprint:{user.id}') is None
+        assert desk.fingerprint() == stale
+
+        with mock.patch.object(cache, 'set') as cache_set:
+            cache.delete(f'inventory-fingerprint:{user.id}')
+            desk.fingerprint()
+        cache_set.assert_called_once_with(f'inventory-fingerprint:{user.id}', stale, timeout=FINGERPRINT_TIMEOUT)
+
+    def test_same_problem_is_solved_once(self):
+        users = [
+            User.objects.generate(stamps_min=1, stamps_max=3, target_value=15, max_value=25)
+            for _ in range(2)
+        ]
+        for user in users:
+            for value in (5, 10, 15):
+                UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=value))
+
+        first = users[0].desk_available.combinations()
+        with mock.patch('combinations.models.anchored', side_effect=AssertionError):
+            second = users[1].desk_available.combinations()
+
+        assert [x.total for x in first] == [x.total for x in second]
+        own_stamps = set(UserStamp.objects.filter(user=users[1]).values_list('id', flat=True))
+        assert all(set(comb.stamp_ids) <= own_stamps for comb in second)
+
+    def test_single_flight(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        desk = user.desk_available
+
+        other = connections.create_connection('default')
+        with other.cursor() as cursor, mock.patch.dict(os.environ, {'COMBINATION_LOCK_WAIT': '0'}):
+            lock_id = int.from_bytes(hashlib.sha1(desk.cache_key().encode()).digest()[:8], 'big', signed=True)
+            cursor.execute('SELECT pg_advisory_lock(%s)', [lock_id])
+            with pytest.raises(CombinationsPending):
+                desk.combinations()
+
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+            assert len(desk.combinations()) == 1
+        other.close()
+
+    def test_pages_are_served_from_local_cache(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        desk = user.desk_available
+
+        combs = desk.combinations()
+        with mock.patch.object(cache, 'get', wraps=cache.get) as shared_get:
+            assert desk.combinations() is combs
+        assert all(call.args[0] != desk.cache_key() for call in shared_get.call_args_list)
+
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        assert len(desk.combinations()) == 2
+
+    def test_changes_schedule_prewarm_once(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        sample = StampSample.objects.generate(value=10)
+
+        with mock.patch.object(prewarm, '_executor') as executor, \
+                mock.patch.object(prewarm.threading, 'Timer') as timer, \
+                self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                UserStamp.objects.generate(user=user, sample=sample)
+            user.save()
+        timer.assert_called_once_with(prewarm.PREWARM_DELAY, executor.submit, (prewarm._run, user.id))
+        timer.return_value.start.assert_called_once_with()
+        prewarm._pending.clear()
+
+        prewarm.warm(user.id)
+        with mock.patch('combinations.models.anchored') as search:
+            assert len(user.desk_available.combinations()) == 1
+        search.assert_not_called()
+
+    def test_job_fills_cache(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        desk = user.desk_available
+
+        with mock.patch.object(jobs, 'submit') as submit, self.captureOnCommitCallbacks(execute=True):
+            job = CombinationJob.objects.enqueue(desk)
+            assert CombinationJob.objects.enqueue(desk) == job
+        submit.assert_called_once_with(job.id)
+        assert desk.cached_combinations() is None
+
+        jobs.run(job.id)
+        job.refresh_from_db()
+        assert (job.status, job.examined, job.total) == (JobStatus.DONE, 1, 1)
+        assert len(desk.cached_combinations()) == 1
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('combinations:job', args=[job.id]))
+        assert response.json()['status'] == JobStatus.DONE
+
+    def test_anytime_combinations(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=3, target_value=10, max_value=40)
+        for value in (5, 10, 15, 20):
+            UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=value))
+        desk = user.desk_available
+        combs = desk.combinations()
+
+        best = desk.anytime_combinations(limit=3)
+        assert not best.exhaustive
+        assert [x.total for x in best] == [x.total for x in combs[:3]]
+
+        everything = desk.anytime_combinations(seconds=60)
+        assert everything.exhaustive
+        assert sorted(x.stamp_ids for x in everything) == sorted(x.stamp_ids for x in combs)
+
+        with mock.patch('combinations.models.ANYTIME_TABLE_LIMIT', 0):
+            cache.delete(f'{desk.cache_key()}:sums')
+            local_cache.clear()
+            skipped = desk.anytime_combinations(seconds=60)
+            assert (list(skipped), skipped.exhaustive) == ([], False)
+
+            desk.ordered_combinations()  # caches the table
+            assert desk.anytime_combinations(seconds=60).exhaustive
+
+    def test_top_combinations(self):
+        user = User.objects.generate(
+            stamps_min=1, stamps_max=3, target_value=20, max_value=40, allow_stamp_repeat=True,
+        )
+        for value, copies in ((5, 4), (10, 1), (20, 1)):
+            sample = StampSample.objects.generate(value=value)
+            for _ in range(copies):
+                UserStamp.objects.generate(user=user, sample=sample)
+        desk = user.desk_available
+
+        assert [x.total for x in desk.top_combinations('overpay', k=3)] == [2000, 2000, 2500]
+        assert [len(x.stamp_ids) for x in desk.top_combinations('stamps', k=2)] == [1, 2]
+        most_duplicated = desk.top_combinations('duplicates', k=1)[0]
+        assert most_duplicated.total == 2000
+        assert list(most_duplicated.sample_ids).count(desk.inventory()[0][0].key) == 2
+
+        user.allow_stamp_repeat = False
+        user.save()
+        most_duplicated = desk.top_combinations('duplicates', k=1)[0]
+        assert most_duplicated.total == 2500  # a 5, the sample with spare copies, and the 20
+        assert list(most_duplicated.sample_ids).count(desk.inventory()[0][0].key) == 1
+
+    def test_top_combinations_past_limit(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=3, target_value=10, max_value=40)
+        for value in (5, 10, 15, 20, 25):
+            UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=value))
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=5))
+        desk = user.desk_available
+        expected = {objective: desk.top_combinations(objective, k=3) for objective in ('overpay', 'stamps')}
+        assert all(x.exhaustive for x in expected.values())
+
+        with mock.patch.dict(os.environ, {'COMBINATION_LIMIT': '1'}):
+            for objective, combs in expected.items():
+                with mock.patch('combinations.models.multisets') as search, \
+                        mock.patch('combinations.models.ordered', wraps=engine.ordered) as streamed:
+                    ranked = desk.top_combinations(objective, k=3, seconds=0)
+                search.assert_not_called()
+                assert streamed.called
+                assert ranked.exhaustive
+                assert [x.stamp_ids for x in ranked] == [x.stamp_ids for x in combs]
+
+            combs = desk.top_combinations('duplicates', k=3, seconds=0)
+        assert combs == [] and not combs.exhaustive
+
+    def test_desks_are_loaded_once(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        user = User.objects.get(id=user.id)
+
+        with self.assertNumQueries(1):
+            desks = [user.desk_available, user.desk_postcard, user.desk_removed, Desk.desk_available(user)]
+        assert [x.type for x in desks] == [DeskType.AVAILABLE, DeskType.POSTCARD, DeskType.REMOVED, DeskType.AVAILABLE]
+
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('combinations:combinations'))
+        assert sum('FROM "combinations_desk"' in query['sql'] for query in queries) == 1
+
+    def test_sidebar_queries_do_not_grow(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        self.client.force_login(user)
+
+        def sidebar_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('combinations:combinations'))
+            return len(queries), response.context['used_stamps'], response.context['removed_stamps']
+
+        empty, _, _ = sidebar_queries()
+        for _ in range(3):
+            sample = StampSample.objects.generate(value=10)
+            for desk in (user.desk_removed, user.desk_removed, user.desk_postcard):
+                UserStamp.objects.generate(user=user, sample=sample, desk=desk)
+        removed_sample = StampSample.objects.generate(value=10)
+        for _ in range(2):
+            UserStamp.objects.generate(user=user, sample=removed_sample, desk=user.desk_removed)
+
+        queries, used, removed = sidebar_queries()
+        assert queries == empty
+        assert len(used) == 3
+        assert [(x.sample_id, x.quantity) for x in removed] == [(removed_sample.id, 2)]
+
+        UserStamp.objects.generate(user=user, sample=used[0].sample, desk=user.desk_postcard)
+        response = self.client.get(reverse('combinations:combinations'))
+        assert sorted(x.quantity for x in response.context['used_stamps']) == [1, 1, 2]
+        assert '&times;&nbsp;2' in response.content.decode()
+
+    def test_hydrate_page(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=2, target_value=10, max_value=30)
+        for value in (5, 10, 15, 20):
+            UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=value))
+
+        combs = user.desk_available.combinations()
+        with self.assertNumQueries(1):
+            page = Combination.hydrate(combs[:3])
+            images = [stamp.sample.image for comb in page for stamp in comb.stamps]
+
+        assert len(images) == sum(len(comb.stamp_ids) for comb in combs[:3])
+        assert [comb.sum() for comb in page] == [sum(x.sample.value for x in comb.stamps) for comb in page]
+
+        deleted_id = UserStamp.objects.get(user=user, sample__value=5).id
+        UserStamp.objects.filter(id=deleted_id).delete()
+        assert Combination.hydrate(combs) == [comb for comb in combs if deleted_id not in comb.stamp_ids]
+
+    def test_limit_counts_only_valid_combinations(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=5, target_value=10, max_value=10)
+
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        for _ in range(100):
+            UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=1000))
+
+        desk = user.desk_available
+        assert desk.combinations_count() == 1
+        assert len(desk.combinations()) == 1
+
+    def test_unknown_strategy(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        desk = user.desk_available
+
+        with pytest.raises(ValueError):
+            desk.combinations(strategy='no-such-strategy')
+        with mock.patch.dict(os.environ, {'COMBINATION_STRATEGY': 'no-such-strategy'}), \
+                self.assertLogs(level='WARNING'):
+            assert len(desk.combinations()) == 1
+
+    def test_count_is_cached(self):
+        user = User.objects.generate(target_value=10, max_value=10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+
+        desk = user.desk_available
+        assert desk.combinations_count() == 1
+        with mock.patch('combinations.models.count') as count:
+            assert desk.combinations_count() == 1
+            assert len(desk.ordered_combinations()) == 1
+        count.assert_not_called()
+
+    def test_invalid_settings(self):
+        user = User.objects.generate(target_value=-20, max_value=-10)
+        UserStamp.objects.generate(user=user, sample=StampSample.objects.generate(value=10))
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('combinations:combinations'))
+        assert response.status_code == 200
+        assert response.context['total_combs'] == 0
+
+        response = self.client.post(reverse('combinations:combinations'), {
+            'stamps_min': 1,
+            'stamps_max': 3,
+            'target_value': 10,
+            'max_value': 10 ** 8,
+        })
+        assert response.status_code == 200
+        assert 'max_value' in response.context['form'].errors
+        user.refresh_from_db()
+        assert user.max_value == -10
+
+    def test_ordered_combinations_pages(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=3, target_value=10, max_value=40)
+        for value in (5, 10, 15, 20, 25):
+            sample = StampSample.objects.generate(value=value)
+            for _ in range(2):
+                UserStamp.objects.generate(user=user, sample=sample, allow_repeat=True)
+
+        desk = user.desk_available
+        combs = desk.combinations()
+        ordered_combs = desk.ordered_combinations()
+
+        assert len(ordered_combs) == len(combs)
+        assert [x.sum() for x in ordered_combs[5:15]] == [x.sum() for x in combs[5:15]]
+        assert ordered_combs[len(combs):len(combs) + 10] == []
 
+        with mock.patch.object(SumTable, 'build', side_effect=AssertionError):
+            assert desk.ordered_combinations()[5:15] == ordered_combs[5:15]
+
+    def test_postcard_stamps_are_kept(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=3, target_value=20, max_value=30)
+        samples = [StampSample.objects.generate(value=value) for value in (5, 10, 15, 20)]
+        stamps = [UserStamp.objects.generate(user=user, sample=sample) for sample in samples]
+
+        stamps[1].to_postcard()
+
+        combs = user.desk_available.combinations()
+        assert combs
+        assert all(stamps[1].id in comb.stamp_ids for comb in combs)
+        assert len(combs) == user.desk_available.combinations_count()
+
+    def test_window_change_uses_index(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=4, target_value=20, max_value=30)
+        for value in (5, 10, 15, 20, 25):
+            sample = StampSample.objects.generate(value=value)
+            for _ in range(2):
+                UserStamp.objects.generate(user=user, sample=sample, allow_repeat=True)
+
+        desk = user.desk_available
+        for target_value, max_value in ((20, 30), (35, 50), (20, 30)):
+            desk.user.calc_settings = {
+                'stamps_min': 1,
+                'stamps_max': 4,
+                'target_value': target_value,
+                'max_value': max_value,
+            }
+
+            denominations, _ = desk.inventory()
+            expected = sorted(multisets(denominations, desk.window()))
+            combs = desk.combinations()
+            assert len(combs) == len(expected)
+            assert [x.sum() for x in combs] == sorted(
+                sum(denominations[i].value for i in pattern) / 100 for pattern in expected
+            )
+
+    def test_stamp_moves_update_result(self):
+        user = User.objects.generate(stamps_min=1, stamps_max=3, target_value=20, max_value=35)
+        stamps = []
+        for value in (5, 10, 15, 20):
+            sample = StampSample.objects.generate(value=value)
+            stamps.extend(UserStamp.objects.generate(user=user, sample=sample, allow_repeat=True) for _ in range(2))
+
+        desk = user.desk_available
+        desk.combinations()
+
+        for move in (stamps[2].to_postcard, stamps[4].to_removed, stamps[2].to_available, stamps[4].to_available):
+            move()
+            with mock.patch('combinations.models.anchored', side_effect=AssertionError):  # no full search
+                combs = desk.combinations()
+            assert set(cache.get(f'combinations-last:{desk.id}')) == {'denominations', 'window', 'shared_key'}
+
+            denominations, _ = desk.inventory()
+            expected = sorted(anchored(multisets, denominations, desk.window()))
+            assert len(combs) == len(expected)
+            assert sorted(sorted(comb.stamp_ids) for comb in combs) == sorted(
+                sorted(comb.stamp_ids) for comb in (
+                    Combination.from_pattern(pattern, *desk.inventory()) for pattern in expected
+                )
+            )
+
+
+class TestEngine(django.test.SimpleTestCase):
+    def test_multisets_respect_caps(self):
+        denominations = [
+            Denomination(key=1, value=500, cap=3),
+            Denomination(key=2, value=1000, cap=1),
+        ]
+        window = Window(low=1000, high=1500, k_min=1, k_max=3)
+
+        patterns = sorted(multisets(denominations, window))
+        assert patterns == [(0, 0), (0, 0, 0), (0, 1), (1,)]
+
+    def test_multisets_keep_required(self):
+        denominations = [
+            Denomination(key=1, value=500, cap=2, required=1),
+            Denomination(key=2, value=1000, cap=1),
+        ]
+        window = Window(low=1000, high=1500, k_min=1, k_max=3)
+
+        patterns = sorted(multisets(denominations, window))
+        assert patterns == [(0, 0), (0, 1)]
+
+    def test_multisets_match_brute_force(self):
+        denominations = [
+            Denomination(key=1, value=100, cap=2),
+            Denomination(key=2, value=250, cap=3, required=1),
+            Denomination(key=3, value=500, cap=1),
+            Denomination(key=4, value=700, cap=2),
+            Denomination(key=5, value=1200, cap=1),
+        ]
+        window = Window(low=1000, high=1600, k_min=2, k_max=4)
+
+        expected = []
+        for counts in itertools.product(*(range(x.cap + 1) for x in denominations)):
+            total = sum(count * x.value for count, x in zip(counts, denominations))
+            if (
+                    window.k_min <= sum(counts) <= window.k_max
+                    and window.low <= total <= window.high
+                    and all(count >= x.required for count, x in zip(counts, denominations))
+            ):
+                expected.append(tuple(i for i, count in enumerate(counts) for _ in range(count)))
+
+        assert sorted(multisets(denominations, window)) == sorted(expected)
+        assert count(denominations, window) == len(expected)
+
+    def test_ordered_by_sum_from_offset(self):
+        denominations = [
+            Denomination(key=1, value=100, cap=3),
+            Denomination(key=2, value=250, cap=2),
+            Denomination(key=3, value=400, cap=1),
+        ]
+        window = Window(low=300, high=900, k_min=1, k_max=4)
+
+        patterns = list(ordered(denominations, window))
+        sums = [sum(denominations[i].value for i in pattern) for pattern in patterns]
+        assert sorted(patterns) == sorted(multisets(denominations, window))
+        assert sums == sorted(sums)
+        assert list(ordered(denominations, window, 7)) == patterns[7:]
+
+    def test_strategies_agree(self):
+        denominations = [
+            Denomination(key=1, value=100, cap=2),
+            Denomination(key=2, value=250, cap=3, required=1),
+            Denomination(key=3, value=500, cap=1),
+            Denomination(key=4, value=700, cap=2),
+            Denomination(key=5, value=900, cap=3),
+        ]
+        window = Window(low=600, high=2600, k_min=1, k_max=5)
+
+        expected = sorted(multisets(denominations, window))
+        for search in STRATEGIES.values():
+            assert sorted(search(denominations, window)) == expected
+            assert sorted(anchored(search, denominations, window)) == expected
+
+    def test_parallel_matches_search(self):
+        denominations = [
+            Denomination(key=1, value=100, cap=2),
+            Denomination(key=2, value=250, cap=3),
+            Denomination(key=3, value=500, cap=1),
+            Denomination(key=4, value=700, cap=2, required=1),
+        ]
+        window = Window(low=600, high=2000, k_min=1, k_max=4)
+
+        with mock.patch.object(engine, 'PARALLEL_THRESHOLD', 0):
+            patterns = list(parallel(denominations, window))
+
+        assert patterns == list(parallel(denominations, window))
+        assert sorted(patterns) == sorted(multisets(denominations, window))
+
+        with mock.patch.object(engine, 'PARALLEL_THRESHOLD', 0), \
+                mock.patch('multiprocessing.parent_process', return_value=object()), \
+                mock.patch.object(engine, '_pool', side_effect=AssertionError):
+            assert list(parallel(denominations, window)) == list(multisets(denominations, window))
+
+    def test_update_after_single_change(self):
+        previous = [
+            Denomination(key=1, value=100, cap=2),
+            Denomination(key=2, value=250, cap=3),
+            Denomination(key=3, value=500, cap=1),
+        ]
+        window = Window(low=500, high=1000, k_min=1, k_max=4)
+        patterns = list(multisets(previous, window))
+
+        changes = (
+            [previous[0], replace(previous[1], required=1), previous[2]],
+            [previous[0], previous[2]],
+            previous + [Denomination(key=4, value=700, cap=1)],
+        )
+        for denominations in changes:
+            expected = sorted(anchored(multisets, denominations, window))
+            assert sorted(update(multisets, previous, patterns, denominations, window)) == expected
+
+        assert update(multisets, previous, patterns, previous[:1], window) is None
+
+    def test_update_after_value_change(self):
+        previous = [Denomination(key=i, value=500 * i, cap=1) for i in (1, 2, 3)]
+        window = Window(low=1500, high=1500, k_min=1, k_max=3)
+        patterns = list(multisets(previous, window))
+
+        denominations = [previous[0], replace(previous[1], value=1100), previous[2]]
+        assert update(multisets, previous, patterns, denominations, window) is None
+        assert list(multisets(denominations, window)) == [(2,)]
+
+    def test_budgeted(self):
+        denominations = [Denomination(key=i, value=100 * i, cap=2) for i in range(1, 6)]
+        window = Window(low=300, high=800, k_min=1, k_max=3)
+        everything = list(ordered(denominations, window))
+
+        assert budgeted(ordered(denominations, window), limit=4) == (everything[:4], False)
+        assert budgeted(ordered(denominations, window), limit=len(everything)) == (everything, True)
+        assert budgeted(ordered(denominations, window), seconds=0) == ([], False)
+
+    def test_top_matches_full_sort(self):
+        denominations = [
+            Denomination(key=i, value=value, cap=cap, copies=copies)
+            for i, (value, cap, copies) in enumerate([(100, 3, 3), (200, 1, 4), (250, 2, 2), (300, 1, 1), (500, 4, 6)])
+        ]
+        window = Window(low=500, high=1200, k_min=1, k_max=4)
+        patterns = list(multisets(denominations, window))
+
+        for name, objective in OBJECTIVES.items():
+            key = lambda p: (objective(p, denominations), least_overpay(p, denominations), p)
+            assert top(iter(patterns), denominations, objective, 5) == sorted(patterns, key=key)[:5], name
+
+    def test_sum_index_between(self):
+        denominations = [
+            Denomination(key=1, value=100, cap=2),
+            Denomination(key=2, value=250, cap=3),
+            Denomination(key=3, value=500, cap=1),
+        ]
+        index = SumIndex.build(denominations, 3)
+
+        assert SumIndex.size(denominations, 3) == len(index.sums)
+        for low, high in ((0, 10_000), (450, 700), (800, 800)):
+            assert sorted(index.between(low, high)) == sorted(
+                multisets(denominations, Window(low=low, high=high, k_min=3, k_max=3))
+            )
+
+
+class TestCompressedFileCache(django.test.SimpleTestCase):
+    def cache(self, location, **options):
+        return CompressedFileCache(location, {'OPTIONS': {'MAX_ENTRIES': 100, **options}})
+
+    def test_counts_hits_and_misses(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = self.cache(location)
+            before = backend.stats()
+
+            backend.set('key', bytes(100_000))
+            assert backend.get('key') == bytes(100_000)
+            assert backend.get('other') is None
+
+            stats = backend.stats()
+            assert stats['hits'] - before['hits'] == 1
+            assert stats['misses'] - before['misses'] == 1
+            assert stats['entries'] == 1
+            assert 0 < stats['bytes'] < 1000  # compressed
+
+    def test_evicts_least_recently_used(self):
+        payload = os.urandom(4000)  # incompressible
+        with tempfile.TemporaryDirectory() as location:
+            backend = self.cache(location, MAX_BYTES=10_000)
+            backend.set('a', payload)
+            backend.set('b', payload)
+            for name, mtime in (('a', 1), ('b', 2)):
+                os.utime(backend._key_to_file(name), (mtime, mtime))
+            backend.get('a')
+
+            backend.set('c', payload)
+
+            assert backend.get('a') == payload
+            assert backend.get('b') is None
+            assert backend.get('c') == payload
+
+    def test_scans_directory_every_n_writes(self):
+        with tempfile.TemporaryDirectory() as location:
+            backend = self.cache(location, MAX_ENTRIES=10 * EVICT_EVERY)
+            with mock.patch.object(backend, '_entries', wraps=backend._entries) as scans, \
+                    self.assertLogs(level='INFO') as logs:
+                for n in range(2 * EVICT_EVERY):
+                    backend.set(f'key-{n}', n)
+            assert scans.call_count == 2  # the first write and the (EVICT_EVERY + 1)th
+            assert len(logs.output) == 2
+            assert f'{EVICT_EVERY + 1} entries' in logs.output[-1]
+            assert backend.stats()['entries'] == 2 * EVICT_EVERY
+
+
+class TestLocalCache(django.test.SimpleTestCase):
+    def test_limits(self):
+        local = LocalCache(max_entries=2, max_bytes=100)
+        local.set('a', 1, size=40)
+        local.set('b', 2, size=40)
+        assert local.get('a') == 1
+
+        local.set('c', 3, size=40)  # over both limits, b is the least recently used
+        assert local.get('b') is None
+        assert (local.get('a'), local.get('c')) == (1, 3)
+
+        local.set('d', 4, size=200)  # larger than the whole tier
+        assert local.get('d') is None
+
+
+@override_settings(CACHES=TEST_CACHES)
 class TestUserStamp(django.test.TestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+
+    def test_copies_are_counted_in_lots(self):
+        user = User.objects.generate()
+        sample = StampSample.objects.generate()
+        lot = UserStamp.objects.generate(user=user, sample=sample, quantity=3)
+        assert UserStamp.objects.generate(user=user, sample=sample, quantity=2) == lot
+
+        postcard = lot.to_postcard()
+        assert postcard.to_postcard() == postcard  # already there, nothing to merge
+        lot.to_removed()
+        assert {(x.desk.type, x.quantity) for x in UserStamp.objects.filter(user=user)} == {
+            (DeskType.AVAILABLE, 3), (DeskType.POSTCARD, 1), (DeskType.REMOVED, 1),
+        }
+
+        postcard.to_available()
+        assert [(x.id, x.quantity) for x in UserStamp.objects.filter(user=user)] == [(lot.id, 5)]
+
+        exported = UserStamp.objects.filter(user=user).to_json()
+        UserStamp.objects.filter(user=user).delete()
+        without_lots = {key: value for key, value in exported[0].items() if key != 'quantity'}
+        UserStamp.objects.from_json(exported + [without_lots])
+        assert [(x.sample, x.quantity) for x in UserStamp.objects.filter(user=user)] == [(sample, 6)]
+
+        assert UserStamp.objects.filter(user=user).remove(4) == 4
+        assert UserStamp.objects.filter(user=user).copies() == 2
+
+        for quantity in (0, -2):
+            with self.assertRaises(ValueError):
+                UserStamp.objects.add(user=user, sample=sample, desk=user.desk_available, quantity=quantity)
+        assert UserStamp.objects.filter(user=user).copies() == 2
+
+    def test_add_view_rejects_non_positive_quantity(self):
+        user = User.objects.generate()
+        sample = StampSample.objects.generate()
+        self.client.force_login(user)
+
+        for quantity in (0, -2):
+            response = self.client.post(
+                reverse('combinations:user-stamp-add', args=[sample.id]),
+                {'quantity': quantity, 'custom_name': '', 'comment': ''},
+            )
+            assert response.status_code == 200
+            assert 'quantity' in response.context['form'].errors
+        assert not UserStamp.objects.filter(user=user).exists()
+
+    def test_bulk_changes_do_not_depend_on_size(self):
+        user = User.objects.generate()
+        samples = [StampSample.objects.generate() for _ in range(6)]
+        for sample in samples:
+            UserStamp.objects.generate(user=user, sample=sample, quantity=4)
+            UserStamp.objects.generate(user=user, sample=sample, quantity=2, desk=user.desk_removed)
+        user = User.objects.get(id=user.id)
+        Desk.desks(user)
+
+        # savepoint, lock, targets, merged lots (loaded for signals) and DELETE, users and UPDATE, release
+        with self.assertNumQueries(8):
+            assert UserStamp.objects.reset(user) == 12
+        assert sorted(UserStamp.objects.filter(user=user).values_list('desk', 'quantity')) == \
+            [(user.desk_available.id, 6)] * 6
+
+        with self.assertNumQueries(6):
+            assert UserStamp.objects.filter(user=user).remove(15) == 15
+        assert UserStamp.objects.filter(user=user).copies() == 21
+
+        with mock.patch('combinations.models.inventory_changed.send') as send:
+            UserStamp.objects.bulk_create([
+                UserStamp(user=user, sample=StampSample.objects.generate(), desk=user.desk_postcard),
+            ])
+        send.assert_called_once_with(sender=UserStamp, user_id=user.id)
+
+        UserStamp.objects.generate(user=user, sample=samples[0], quantity=2, desk=user.desk_postcard)
+        with CaptureQueriesContext(connection) as queries:
+            assert UserStamp.objects.stick(user) == 3
+        locks = [query['sql'] for query in queries if query['sql'].endswith('FOR UPDATE')]
+        assert len(locks) == 1 and 'SUM(' not in locks[0]  # the lots themselves are locked
+        assert UserStamp.objects.filter(user=user).copies() == 21
+
+    def test_create_form_offers_samples_not_owned(self):
+        user = User.objects.generate()
+        owned, new = StampSample.objects.generate(), StampSample.objects.generate()
+        UserStamp.objects.generate(user=user, sample=owned, quantity=3)
+        UserStamp.objects.generate(user=user, sample=owned, desk=user.desk_removed)
+
+        with self.assertNumQueries(0):
+            form = UserStampCreateForm(user=user)
+        with self.assertNumQueries(1):  # owned samples are a subquery
+            samples = list(form.fields['sample'].queryset)
+        assert new in samples and owned not in samples
+
+    def test_grouped_pages(self):
+        user = User.objects.generate()
+        samples = [StampSample.objects.generate(value=value) for value in (30, 10, 20, 10)]
+        for copies, sample in enumerate(samples, 1):
+            for _ in range(copies):
+                UserStamp.objects.generate(user=user, sample=sample)
+
+        stamps = UserStamp.objects.filter(user=user)
+        with self.assertNumQueries(2):
+            first = stamps.grouped(limit=3)
+        second = stamps.grouped(after=(first[-1]['sample'].value, first[-1]['sample'].id), limit=3)
+
+        pages = first + second
+        assert [x['sample'] for x in pages] == [samples[1], samples[3], samples[2], samples[0]]
+        assert [x['quantity'] for x in pages] == [2, 4, 3, 1]
+        assert all(UserStamp.objects.get(id=x['id']).sample == x['sample'] for x in pages)
+
     def test_to_json(self):
         user = User.objects.generate()
 
@@ -14,5 +14,6 @@ urlpatterns = [
     path('user-stamps/add/<int:sample_id>/', views.user_stamp_add_view, name='user-stamp-add'),
     path('user-stamps/<int:stamp_id>/', views.user_stamps_edit_view, name='user-stamp-edit'),
     path('combinations/', views.combinations_view, name='combinations'),
+    path('combinations/jobs/<int:job_id>/', views.combination_job_view, name='job'),
     path('combinations/stick/', views.stick_stamps_to_postcard, name='stick_stamps'),
 ]
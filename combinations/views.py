@@ -4,22 +4,26 @@ from decimal import Decimal
 from logging import getLogger
 
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest
-from django.shortcuts import redirect
+from django.db import transaction
+from django.http import HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.shortcuts import render
 from django.urls import reverse
 from django.views import View
 from django.views.decorators.http import require_http_methods
 from django.views.generic import ListView
 
+from stamp_assist.settings import env
+from .engine import OBJECTIVES
 from .forms import CalcConfigForm, ColnectCreateForm, UserStampCreateForm, UserStampEditForm, \
     UserStampAddForm
-from .models import StampSample, UserStamp, Desk, DeskType
+from .models import StampSample, UserStamp, Desk, Combination, CombinationJob
 
 logger = getLogger()
 
+STAMPS_PER_PAGE = 60
+
 
 def index_view(request):
     if request.user.is_authenticated:
@@ -126,25 +130,21 @@ def user_stamp_add_view(request, sample_id: int):
     sample = StampSample.objects.get(id=sample_id)
 
     if request.method == 'POST':
-        form = UserStampAddForm(request.POST)
+        form = UserStampAddForm(request.POST, initial={'original_name': sample.name})
         if form.is_valid():
             data = form.cleaned_data
-            desk = Desk.objects.get(
+            UserStamp.objects.add(
                 user=request.user,
-                type=DeskType.AVAILABLE,
+                sample=sample,
+                desk=Desk.desk_available(request.user),
+                quantity=int(data['quantity']),
+                custom_name=data['custom_name'],
+                comment=data['comment'],
             )
-            for _ in range(int(data['quantity'])):
-                UserStamp.objects.create(
-                    sample=sample,
-                    custom_name=data['custom_name'],
-                    comment=data['comment'],
-                    user=request.user,
-                    desk=desk,
-                )
 
             return HttpResponseRedirect(reverse('combinations:samples'))
-
-    form = UserStampAddForm(initial={'original_name': sample.name})
+    else:
+        form = UserStampAddForm(initial={'original_name': sample.name})
 
     context = {
         'sample': sample,
@@ -162,36 +162,34 @@ def user_stamps_list_view(request):
         form = UserStampCreateForm(request.POST)
         if form.is_valid():
             data = form.cleaned_data
-            for _ in range(int(data['quantity'])):
-                desk = Desk.objects.get(
-                    user=request.user,
-                    type=DeskType.AVAILABLE,
-                )
-                UserStamp.objects.create(
-                    sample=data['sample'],
-                    custom_name=data['custom_name'],
-                    comment=data['comment'],
-                    user=request.user,
-                    desk=desk,
-                )
+            UserStamp.objects.add(
+                user=request.user,
+                sample=data['sample'],
+                desk=Desk.desk_available(request.user),
+                quantity=int(data['quantity']),
+                custom_name=data['custom_name'],
+                comment=data['comment'],
+            )
 
     form = UserStampCreateForm(user=request.user)
 
-    stamps = {}
-    for stamp in UserStamp.objects.filter(user=request.user).prefetch_related('sample').order_by('sample__value'):
-        if stamp.sample.slug not in stamps:
-            stamps[stamp.sample.slug] = {
-                'id': stamp.id,
-                'sample': stamp.sample,
-                'custom_name': stamp.custom_name,
-                'comment': stamp.comment,
-                'quantity': 0,
-                'allow_repeat': stamp.allow_repeat,
-            }
-        stamps[stamp.sample.slug]['quantity'] += 1
+    after = None
+    if cursor := request.GET.get('after'):
+        try:
+            value, sample_id = cursor.split('_')
+            after = Decimal(value), int(sample_id)
+        except (ValueError, ArithmeticError):
+            return HttpResponseBadRequest('Invalid page cursor')
+    stamps = UserStamp.objects.filter(user=request.user).grouped(after, limit=STAMPS_PER_PAGE + 1)
+
+    next_cursor = None
+    if len(stamps) > STAMPS_PER_PAGE:
+        stamps = stamps[:STAMPS_PER_PAGE]
+        next_cursor = f'{stamps[-1]["sample"].value}_{stamps[-1]["sample"].id}'
 
     context = {
         'stamps': stamps,
+        'next_cursor': next_cursor,
         'form_create': form,
     }
 
@@ -206,38 +204,40 @@ def user_stamps_edit_view(request, stamp_id: int):
     init_stamps_count = UserStamp.objects.filter(
         user=stamp.user,
         sample=stamp.sample,
-    ).count()
+    ).copies()
 
     if request.method == 'POST':
         form = UserStampEditForm(request.POST)
         if form.is_valid():
             data = form.cleaned_data
-            if data['quantity_change'] > 0:
-                for _ in range(data['quantity_change']):
-                    UserStamp.objects.create(
-                        sample=stamp.sample,
+            if data['quantity_change'] < 0 and abs(data['quantity_change']) > init_stamps_count:
+                return HttpResponseBadRequest('Not enough stamps to remove')
+
+            with transaction.atomic():
+                if data['quantity_change'] > 0:
+                    UserStamp.objects.add(
                         user=request.user,
+                        sample=stamp.sample,
                         desk=Desk.desk_available(request.user),
+                        quantity=data['quantity_change'],
+                        custom_name=stamp.custom_name,
+                        comment=stamp.comment,
+                        allow_repeat=stamp.allow_repeat,
                     )
-            elif data['quantity_change'] < 0:
-                if abs(data['quantity_change']) > init_stamps_count:
-                    return HttpResponseBadRequest('Not enough stamps to remove')
+                elif data['quantity_change'] < 0:
+                    UserStamp.objects.filter(
+                        sample=stamp.sample,
+                        user=request.user,
+                    ).remove(abs(data['quantity_change']))
 
-                stamps_to_delete = UserStamp.objects.filter(
+                UserStamp.objects.filter(
                     sample=stamp.sample,
                     user=request.user,
-                )[:abs(data['quantity_change'])]
-                for stamp in stamps_to_delete:
-                    stamp.delete()
-
-            UserStamp.objects.filter(
-                sample=stamp.sample,
-                user=request.user,
-            ).update(
-                custom_name=data['custom_name'],
-                comment=data['comment'],
-                allow_repeat=data['allow_repeat'],
-            )
+                ).update(
+                    custom_name=data['custom_name'],
+                    comment=data['comment'],
+                    allow_repeat=data['allow_repeat'],
+                )
 
             return HttpResponseRedirect(reverse('combinations:user-stamps'))
 
@@ -247,10 +247,7 @@ def user_stamps_edit_view(request, stamp_id: int):
         'original_name': stamp.sample.name,
         'custom_name': stamp.custom_name,
         'comment': stamp.comment,
-        'quantity': UserStamp.objects.filter(
-            user=stamp.user,
-            sample=stamp.sample,
-        ).count(),
+        'quantity': init_stamps_count,
         'allow_repeat': stamp.allow_repeat,
     }
     form = UserStampEditForm(initial=data)
@@ -265,61 +262,57 @@ def user_stamps_edit_view(request, stamp_id: int):
 
 def combinations_view(request):
     combs = None
-    error = None
+    job = None
+    form = None
+    objective = request.GET.get('objective')
     if request.method == 'POST':
         if all(field in request.POST.keys() for field in CalcConfigForm.declared_fields):
-            new_settings = {
-                'stamps_min': int(request.POST['stamps_min']),
-                'stamps_max': int(request.POST['stamps_max']),
-                'target_value': Decimal(request.POST['target_value']),
-                'max_value': Decimal(request.POST['max_value']),
-            }
-
-            request.user.calc_settings = new_settings
-            request.user.save()
+            form = CalcConfigForm(request.POST)
+            if form.is_valid():
+                data = form.cleaned_data
+                request.user.calc_settings = {
+                    'stamps_min': int(data['stamps_min']),
+                    'stamps_max': int(data['stamps_max']),
+                    'target_value': data['target_value'],
+                    'max_value': data['max_value'],
+                }
+                request.user.save()
 
         if stamp_id := request.POST.get('use_stamp'):
-            stamp = UserStamp.objects.get(id=stamp_id)
-            stamp.to_postcard()
-
-            if not request.user.allow_stamp_repeat and not stamp.allow_repeat:
-                UserStamp.objects \
-                    .filter(user=request.user, sample=stamp.sample) \
-                    .exclude(id=stamp_id) \
-                    .update(desk=Desk.desk_removed(request.user))
+            stamp = request.user.stamps.get(id=stamp_id)
+            with transaction.atomic():
+                stamp.to_postcard()
+
+                if not request.user.allow_stamp_repeat and not stamp.allow_repeat:
+                    UserStamp.objects \
+                        .filter(user=request.user, sample=stamp.sample) \
+                        .exclude(desk=Desk.desk_postcard(request.user)) \
+                        .move_to(Desk.desk_removed(request.user))
         elif stamp_id := request.POST.get('remove_stamp'):
-            stamp = UserStamp.objects.get(id=stamp_id)
-            if stamp.desk in (Desk.desk_postcard(request.user), Desk.desk_removed(request.user)):
+            stamp = request.user.stamps.get(id=stamp_id)
+            if stamp.desk_id in (Desk.desk_postcard(request.user).id, Desk.desk_removed(request.user).id):
                 stamp.to_available()
             else:
-                UserStamp.objects.filter(
-                    user=stamp.user,
-                    sample=stamp.sample,
-                ).update(desk=Desk.desk_removed(request.user))
+                UserStamp.objects.move_sample(request.user, stamp.sample, Desk.desk_removed(request.user))
         elif 'reset' in request.POST:
-            desk = Desk.desk_available(request.user)
-            desk.clear_cache()
-            UserStamp.objects \
-                .filter(user=request.user) \
-                .exclude(desk=desk) \
-                .update(desk=desk)
+            UserStamp.objects.reset(request.user)
             # return redirect(reverse('combinations:combinations'))
 
-        if 'reset' not in request.POST:
-            desk = Desk.desk_available(request.user)
-            desk.clear_cache()
-            try:
-                combs = desk.combinations()
-            except ValidationError as e:
-                error = e.message
+        if form is None or form.is_valid():
+            return redirect('combinations:combinations')
 
-        return redirect('combinations:combinations')
+    desk = Desk.desk_available(request.user)
+    total_combs = desk.combinations_count()
+    if objective in OBJECTIVES:
+        combs = desk.top_combinations(objective, k=env('COMBINATION_TOP'), seconds=env('COMBINATION_BUDGET'))
+    elif total_combs > env('COMBINATION_LIMIT'):
+        combs = desk.ordered_combinations()
     else:
-        desk = Desk.desk_available(request.user)
-        try:
-            combs = desk.combinations()
-        except ValidationError as e:
-            error = e.message
+        combs = desk.cached_combinations()
+        if combs is None:
+            combs = desk.anytime_combinations(seconds=env('COMBINATION_BUDGET'))
+            if not combs.exhaustive:
+                job = CombinationJob.objects.enqueue(desk)
 
     if combs:
         paginator = Paginator(combs, 10)
@@ -331,49 +324,52 @@ def combinations_view(request):
             p_combs = paginator.page(1)
         except EmptyPage:
             p_combs = paginator.page(paginator.num_pages)
+        p_combs.object_list = Combination.hydrate(p_combs.object_list)
     else:
         paginator = Paginator([], 10)
         p_combs = paginator.page(1)
 
-    request.user.refresh_from_db()
-    form = CalcConfigForm(initial=request.user.calc_settings)
+    if form is None:
+        request.user.refresh_from_db()
+        form = CalcConfigForm(initial=request.user.calc_settings)
 
     used_stamps = UserStamp.objects.filter(
         user=request.user,
         desk=Desk.desk_postcard(request.user),
-    )
-    used_stamps_ids = [x.sample.id for x in used_stamps]
+    ).select_related('sample').only('id', 'quantity', 'sample__image')
 
-    removed_samples = []
-    removed_stamps_tmp = UserStamp.objects.filter(
-            user=request.user,
-            desk=Desk.desk_removed(request.user),
-        ).exclude(sample_id__in=used_stamps_ids)
-
-    removed_stamps = []
-    for stamp in removed_stamps_tmp:
-        if stamp.sample not in removed_samples:
-            removed_samples.append(stamp.sample)
-            removed_stamps.append(stamp)
+    # One stamp of every removed sample that is not on the postcard
+    removed_stamps = UserStamp.objects \
+        .filter(user=request.user, desk=Desk.desk_removed(request.user)) \
+        .exclude(sample_id__in=used_stamps.values('sample_id')) \
+        .order_by('sample_id', 'id') \
+        .distinct('sample_id') \
+        .select_related('sample') \
+        .only('id', 'sample_id', 'quantity', 'sample__image')
 
     context = {
         'form': form,
         'combs': p_combs,
-        'total_combs': len(combs) if combs else 0,
+        'total_combs': total_combs,
         'used_stamps': used_stamps,
         'removed_stamps': removed_stamps,
-        'error': error,
+        'job': job,
+        'objective': objective,
+        'ranked_partially': objective in OBJECTIVES and not combs.exhaustive,
     }
 
     return render(request, 'combinations/combinations.html', context)
 
 
+@login_required
+def combination_job_view(request, job_id: int):
+    job = get_object_or_404(CombinationJob, id=job_id, user=request.user)
+    return JsonResponse(job.to_json())
+
+
 @require_http_methods(['POST'])
 @login_required
 def stick_stamps_to_postcard(request):
-    UserStamp.objects.filter(
-        user=request.user,
-        desk=request.user.desks.get(type=DeskType.POSTCARD),
-    ).delete()
+    UserStamp.objects.stick(request.user)
 
     return HttpResponseRedirect(reverse('combinations:combinations'))
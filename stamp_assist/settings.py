@@ -34,6 +34,19 @@ env = environ.Env(
     IMAGE_KIT_ENDPOINT=(str, 'some-endpoint'),
     IMAGE_KIT_FOLDER=(str, 'some-folder'),
     COMBINATION_LIMIT=(int, 100_000),
+    COMBINATION_MAX_VALUE=(int, 1000),
+    COMBINATION_STRATEGY=(str, 'mitm'),
+    COMBINATION_INDEX_LIMIT=(int, 50_000),
+    COMBINATION_LOCK_WAIT=(int, 10),
+    COMBINATION_PREWARM=(bool, True),
+    COMBINATION_JOB_WORKERS=(int, 2),
+    COMBINATION_PARALLEL_WORKERS=(int, 2),
+    COMBINATION_BUDGET=(float, 0.5),
+    COMBINATION_TOP=(int, 10),
+    COMBINATION_LOCAL_ENTRIES=(int, 32),
+    COMBINATION_LOCAL_BYTES=(int, 64 * 1024 * 1024),
+    CACHE_LOCATION=(str, '/tmp/stamp_assist_cache'),
+    CACHE_MAX_BYTES=(int, 256 * 1024 * 1024),
 )
 env.read_env(BASE_DIR.joinpath('.env'))
 # Quick-start development settings - unsuitable for production
@@ -108,6 +121,17 @@ DATABASES = {
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'combinations.cache.CompressedFileCache',
+        'LOCATION': env('CACHE_LOCATION'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 100_000,
+            'MAX_BYTES': env('CACHE_MAX_BYTES'),
+        },
+    },
+}
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,